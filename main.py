@@ -1,30 +1,87 @@
 import logging
-from datetime import datetime
+import asyncio
+import argparse
+import contextlib
+from datetime import datetime, date, timedelta
 from dateutil.relativedelta import relativedelta
 import calendar
-import matplotlib.pyplot as plt
-import seaborn as sns
-import pandas as pd
-from io import BytesIO, StringIO
+import csv
+import io
+import unicodedata
+from io import BytesIO
 import random
 import locale
 import threading
 import os
-from flask import Flask, render_template_string, jsonify
+import sys
+import subprocess
+import tempfile
+import time
+import re
+import json
+import hashlib
+import hmac
+import signal
+import resource
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from bisect import bisect_left
+from collections import deque, OrderedDict
+from functools import lru_cache
+from starlette.applications import Starlette
+from starlette.responses import HTMLResponse, JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+import uvicorn
 import pytz
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler, ContextTypes
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, MessageEntity
+from telegram.ext import Application, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, MessageHandler, filters, CallbackQueryHandler, ContextTypes
+from telegram.error import BadRequest, RetryAfter
+from telegram.request import HTTPXRequest
 
-import os
 import psycopg
+from psycopg import sql
+from psycopg_pool import ConnectionPool, AsyncConnectionPool, PoolTimeout
 
 # --- CONFIGURAÇÃO DE LOGGING ---
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO)
 
+# --- DEPENDÊNCIAS DE ANÁLISE (CARREGADAS SOB DEMANDA) ---
+# pandas/matplotlib/seaborn/Pillow levam mais de um segundo para importar e só
+# são usados nos relatórios; carregar_analise() os importa na primeira vez.
+REPORT_WARMUP = os.getenv("REPORT_WARMUP", "false").lower() in ("1", "true", "sim")
+
+pd = sns = mpl_style = Figure = Image = None
+_analise_lock = threading.Lock()
+
+def carregar_analise():
+    """Importa a pilha de análise (idempotente e thread-safe)"""
+    global pd, sns, mpl_style, Figure, Image
+    if pd is not None:
+        return
+    with _analise_lock:
+        if pd is not None:
+            return
+        inicio = time.perf_counter()
+        from matplotlib import style as _mpl_style
+        from matplotlib.figure import Figure as _Figure
+        from PIL import Image as _Image
+        import seaborn as _sns
+        import pandas as _pd
+        sns, mpl_style, Figure, Image = _sns, _mpl_style, _Figure, _Image
+        pd = _pd  # por último: é o indicador de que tudo foi carregado
+        logging.info(f"Pilha de análise carregada em {time.perf_counter() - inicio:.2f}s")
+
+async def carregar_analise_async():
+    """Carrega a pilha de análise sem travar o event loop"""
+    if pd is None:
+        await asyncio.to_thread(carregar_analise)
+
 # --- SUBCATEGORIAS E CARTÕES ESPECIAIS ---
 SUBCATEGORIAS_CARTAO = [
     "MERCADO 🛒",
@@ -44,76 +101,694 @@ CARTOES_ESPECIAIS = [
     "Cartão BRB"
 ]
 
-# --- CONEXÃO COM O BANCO DE DADOS ---
-def get_connection():
-    """Função para obter uma nova conexão com o banco de dados"""
+# --- MÉTRICAS DE QUERIES ---
+LATENCIA_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "500"))
+SLOW_QUERY_LOG_SIZE = int(os.getenv("SLOW_QUERY_LOG_SIZE", "100"))
+
+class Histograma:
+    """Histograma de latências (em segundos) com buckets fixos, no formato do Prometheus"""
+
+    def __init__(self, buckets=LATENCIA_BUCKETS):
+        self.buckets = buckets
+        # Um contador por bucket + o bucket "+Inf"
+        self.contagens = [0] * (len(buckets) + 1)
+        self.soma = 0.0
+        self.total = 0
+
+    def observar(self, valor):
+        self.contagens[bisect_left(self.buckets, valor)] += 1
+        self.soma += valor
+        self.total += 1
+
+    def snapshot(self):
+        """Retorna os buckets acumulados, a soma e o total de observações"""
+        acumulado, buckets = 0, []
+        for limite, contagem in zip(self.buckets, self.contagens):
+            acumulado += contagem
+            buckets.append((limite, acumulado))
+        buckets.append((float('inf'), self.total))
+        return {'buckets': buckets, 'soma': self.soma, 'total': self.total}
+
+_metricas_lock = threading.Lock()
+_metricas_queries = {}
+_metricas_db = {'retries': 0}
+_slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+
+@lru_cache(maxsize=512)
+def rotulo_query(query):
+    """Normaliza o texto da query para usá-lo como rótulo das métricas"""
+    return re.sub(r'\s+', ' ', query).strip()[:120]
+
+def _metricas_da_query(rotulo):
+    metricas = _metricas_queries.get(rotulo)
+    if metricas is None:
+        metricas = _metricas_queries[rotulo] = {
+            'latencia': Histograma(), 'linhas': 0, 'erros': 0, 'retries': 0}
+    return metricas
+
+def registrar_query(rotulo, duracao, linhas=0):
+    """Registra a latência e as linhas retornadas de uma query bem-sucedida"""
+    with _metricas_lock:
+        metricas = _metricas_da_query(rotulo)
+        metricas['latencia'].observar(duracao)
+        metricas['linhas'] += linhas or 0
+
+    duracao_ms = duracao * 1000
+    if duracao_ms >= SLOW_QUERY_MS:
+        logging.warning(f"Query lenta ({duracao_ms:.0f} ms, {linhas} linhas): {rotulo}")
+        with _metricas_lock:
+            _slow_queries.append({
+                'query': rotulo,
+                'duracao_ms': round(duracao_ms, 1),
+                'linhas': linhas,
+                'timestamp': datetime.now().isoformat(),
+            })
+
+def registrar_erro_query(rotulo, retry=False):
+    """Registra uma falha de query; retry=True indica que haverá nova tentativa com reconexão"""
+    with _metricas_lock:
+        metricas = _metricas_da_query(rotulo)
+        metricas['erros'] += 1
+        if retry:
+            metricas['retries'] += 1
+            _metricas_db['retries'] += 1
+
+def get_query_metrics():
+    """Retorna um snapshot das métricas de banco, pronto para exportação"""
+    with _metricas_lock:
+        queries = {
+            rotulo: {
+                **m['latencia'].snapshot(),
+                'linhas': m['linhas'],
+                'erros': m['erros'],
+                'retries': m['retries'],
+            }
+            for rotulo, m in _metricas_queries.items()
+        }
+        resultado = {
+            'queries': queries,
+            **_metricas_db,
+            'slow_query_ms': SLOW_QUERY_MS,
+            'slow_queries': list(_slow_queries),
+        }
+    resultado['pool'] = pool.get_stats() if pool is not None else {}
+    resultado['pool_async'] = async_pool.get_stats() if async_pool is not None else {}
+    return resultado
+
+# --- MÉTRICAS DA APLICAÇÃO (HANDLERS, RELATÓRIOS, TELEGRAM) ---
+TAMANHO_BUCKETS = (10_000, 50_000, 100_000, 250_000, 500_000, 1_000_000, 2_500_000, 5_000_000, 10_000_000)
+
+# Prefixos de callback_data que carregam parâmetros (IDs, categorias, datas).
+# A ordem importa: prefixos mais específicos primeiro.
+PREFIXOS_CALLBACK = [
+    'rel_gerar_', 'rel_tend_', 'orc_cat_', 'orc_gastos_', 'subcat_', 'cat_', 'show_tx_', 'edit_tx_',
+    'confirm_delete_', 'delete_tx_', 'edit_campo_', 'edit_cat_select_', 'data_',
+]
+
+_metricas_handlers = {}
+_metricas_relatorios = {}
+_metricas_telegram = {}
+_inicio_processo = time.time()
+
+def rotulo_callback(data):
+    """Reduz o callback_data ao seu prefixo, para não criar uma série por ID/categoria"""
+    for prefixo in PREFIXOS_CALLBACK:
+        if data.startswith(prefixo):
+            return prefixo.rstrip('_')
+    return data if re.fullmatch(r'[a-z_]+', data or '') else 'outros'
+
+def _rotulo_handler(update):
+    if update.callback_query:
+        return rotulo_callback(update.callback_query.data)
+    message = update.effective_message
+    # Só comandos de verdade (entidade bot_command no início) viram rótulo; eles só chegam
+    # aqui pelos CommandHandler registrados. Texto comum começando com '/' não cria séries.
+    entidade = message.entities[0] if message and message.entities else None
+    if entidade and entidade.type == MessageEntity.BOT_COMMAND and entidade.offset == 0:
+        return message.text[:entidade.length].split('@')[0]
+    return 'mensagem'
+
+def registrar_handler(rotulo, duracao, erro=False):
+    with _metricas_lock:
+        metricas = _metricas_handlers.setdefault(rotulo, {'latencia': Histograma(), 'erros': 0})
+        metricas['latencia'].observar(duracao)
+        metricas['erros'] += int(erro)
+
+def registrar_relatorio(tipo, duracao, tamanho):
+    with _metricas_lock:
+        metricas = _metricas_relatorios.setdefault(
+            tipo, {'latencia': Histograma(), 'tamanho': Histograma(TAMANHO_BUCKETS)})
+        metricas['latencia'].observar(duracao)
+        metricas['tamanho'].observar(tamanho)
+
+def registrar_telegram(metodo, duracao, erro=False):
+    with _metricas_lock:
+        metricas = _metricas_telegram.setdefault(metodo, {'latencia': Histograma(), 'erros': 0})
+        metricas['latencia'].observar(duracao)
+        metricas['erros'] += int(erro)
+
+def instrumentar_handler(func):
+    """Mede a latência de um handler do bot, rotulada pelo prefixo do callback/comando"""
+    @functools.wraps(func)
+    async def wrapper(update, context, *args, **kwargs):
+        rotulo = _rotulo_handler(update)
+        inicio = time.perf_counter()
+        erro = False
+        try:
+            return await func(update, context, *args, **kwargs)
+        except Exception:
+            erro = True
+            raise
+        finally:
+            registrar_handler(rotulo, time.perf_counter() - inicio, erro)
+    return wrapper
+
+def _tamanho_buffer(buffer):
+    if buffer is None:
+        return 0
+    if isinstance(buffer, bytes):
+        return len(buffer)
+    return buffer.getbuffer().nbytes
+
+class HTTPXRequestInstrumentado(HTTPXRequest):
+    """HTTPXRequest que registra a latência e os erros de cada chamada à Bot API"""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        # Downloads (/file/bot<token>/<caminho>) viram um rótulo só; nas chamadas à
+        # Bot API o último segmento é o nome do método
+        metodo = 'download' if '/file/bot' in url else url.rsplit('/', 1)[-1]
+        inicio = time.perf_counter()
+        erro = True
+        try:
+            status_code, payload = await super().do_request(url, method, *args, **kwargs)
+            erro = status_code >= 400
+            return status_code, payload
+        finally:
+            registrar_telegram(metodo, time.perf_counter() - inicio, erro)
+
+# --- AGENDADOR DE ENVIOS AO TELEGRAM ---
+# Limites da Bot API: ~30 mensagens/s no total, ~1/s por chat privado (com
+# pequenas rajadas) e 20/min por grupo
+TELEGRAM_RATE_GLOBAL = float(os.getenv("TELEGRAM_RATE_GLOBAL", "30"))
+TELEGRAM_RATE_CHAT = float(os.getenv("TELEGRAM_RATE_CHAT", "1"))
+TELEGRAM_RATE_GRUPO = float(os.getenv("TELEGRAM_RATE_GRUPO", str(20 / 60)))
+TELEGRAM_BURST_CHAT = int(os.getenv("TELEGRAM_BURST_CHAT", "4"))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))
+# Chamadas que não geram mensagens e por isso não gastam o limite do chat
+METODOS_SEM_LIMITE_CHAT = frozenset({'deleteMessage', 'deleteMessages', 'answerCallbackQuery', 'sendChatAction'})
+# Chamadas que mudam uma mensagem existente: invalidam o cache de mensagens renderizadas
+METODOS_ALTERAM_MENSAGEM = frozenset({'editMessageText', 'editMessageReplyMarkup', 'editMessageCaption',
+                                      'editMessageMedia', 'deleteMessage'})
+
+class BaldeTokens:
+    """Token bucket: `taxa` tokens por segundo, acumulando até `capacidade`"""
+
+    def __init__(self, taxa, capacidade):
+        self.taxa = taxa
+        self.capacidade = capacidade
+        self.tokens = capacidade
+        self.atualizado = time.monotonic()
+        self.pausado_ate = 0.0
+        self.esperando = 0
+        self._fila = asyncio.Lock()  # acorda quem espera na ordem de chegada
+
+    def _repor(self):
+        agora = time.monotonic()
+        self.tokens = min(self.capacidade, self.tokens + (agora - self.atualizado) * self.taxa)
+        self.atualizado = agora
+        return agora
+
+    def pausar(self, segundos):
+        """Segura o balde por `segundos` (pedido pelo Telegram via RetryAfter)"""
+        self.pausado_ate = max(self.pausado_ate, time.monotonic() + segundos)
+
+    def ocioso(self):
+        agora = self._repor()
+        return self.esperando == 0 and agora >= self.pausado_ate and self.tokens >= self.capacidade
+
+    async def adquirir(self, desistir=None):
+        """Espera um token, na ordem de chegada; devolve False se desistir() ficar verdadeiro antes"""
+        self.esperando += 1
+        try:
+            # Só o primeiro da fila dorme esperando token: mensagens ao mesmo chat saem em ordem
+            async with self._fila:
+                while True:
+                    if desistir is not None and desistir():
+                        return False
+                    agora = self._repor()
+                    if agora >= self.pausado_ate and self.tokens >= 1:
+                        self.tokens -= 1
+                        return True
+                    await asyncio.sleep(max(self.pausado_ate - agora, (1 - self.tokens) / self.taxa))
+        finally:
+            self.esperando -= 1
+
+class AgendadorTelegram(BaseRateLimiter):
+    """Rate limiter da Bot API: baldes global e por chat, edições coalescidas e retry em RetryAfter"""
+
+    def __init__(self):
+        self._global = BaldeTokens(TELEGRAM_RATE_GLOBAL, TELEGRAM_RATE_GLOBAL)
+        self._chats = {}
+        # (chat_id, message_id) -> edição mais recente ainda não enviada
+        self._edicoes = {}
+        self.stats = {'coalescidas': 0, 'retry_after': 0, 'espera_segundos': 0.0}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        self._chats.clear()
+        self._edicoes.clear()
+
+    def _balde_chat(self, chat_id):
+        balde = self._chats.get(chat_id)
+        if balde is None:
+            if len(self._chats) >= 1000:
+                for ocioso in [c for c, b in self._chats.items() if b.ocioso()]:
+                    del self._chats[ocioso]
+            # ids negativos (e @username) são grupos/canais
+            grupo = isinstance(chat_id, str) or int(chat_id) < 0
+            balde = self._chats[chat_id] = BaldeTokens(
+                TELEGRAM_RATE_GRUPO if grupo else TELEGRAM_RATE_CHAT, TELEGRAM_BURST_CHAT)
+        return balde
+
+    def profundidade(self):
+        """Requisições aguardando token, no balde global e nos baldes por chat"""
+        por_chat = [balde.esperando for balde in self._chats.values()]
+        return {'global': self._global.esperando, 'chat': sum(por_chat),
+                'chats_com_fila': sum(1 for n in por_chat if n)}
+
+    def _registrar_edicao(self, chave):
+        edicao = {'futuro': asyncio.get_running_loop().create_future(), 'substituta': None}
+        # Marca a exceção como consumida mesmo que nenhuma edição antiga espere por ela
+        edicao['futuro'].add_done_callback(lambda f: f.cancelled() or f.exception())
+        anterior = self._edicoes.get(chave)
+        if anterior is not None:
+            anterior['substituta'] = edicao['futuro']
+        self._edicoes[chave] = edicao
+        return edicao
+
+    def _registrar_renderizada(self, chave, edicao, data):
+        """Guarda no cache o conteúdo da edição que chegou à API.
+
+        Se uma edição mais nova da mesma mensagem já está na fila, é ela quem define a tela.
+        """
+        if edicao['substituta'] is None:
+            _guardar_mensagem_renderizada(
+                *chave, (data.get('text'), data.get('reply_markup'), data.get('parse_mode')))
+
+    async def _aguardar_tokens(self, chat_id, endpoint, desistir):
+        inicio = time.monotonic()
+        try:
+            if chat_id is not None and endpoint not in METODOS_SEM_LIMITE_CHAT:
+                if not await self._balde_chat(chat_id).adquirir(desistir):
+                    return False
+            return await self._global.adquirir(desistir)
+        finally:
+            self.stats['espera_segundos'] += time.monotonic() - inicio
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        max_tentativas = rate_limit_args if isinstance(rate_limit_args, int) else TELEGRAM_MAX_RETRIES
+        if endpoint in METODOS_ALTERAM_MENSAGEM and chat_id is not None:
+            descartar_mensagem_renderizada(chat_id, data.get('message_id'))
+        edicao = chave = None
+        if endpoint == 'editMessageText' and chat_id is not None and data.get('message_id') is not None:
+            chave = (chat_id, data['message_id'])
+            edicao = self._registrar_edicao(chave)
+        desistir = (lambda: edicao['substituta'] is not None) if edicao else None
+        coalescida = False
+
+        try:
+            for tentativa in range(max_tentativas + 1):
+                if not await self._aguardar_tokens(chat_id, endpoint, desistir):
+                    # Uma edição mais nova da mesma mensagem chegou: ela é quem vai para a API
+                    self.stats['coalescidas'] += 1
+                    coalescida = True
+                    resultado = await edicao['substituta']
+                    break
+                try:
+                    resultado = await callback(*args, **kwargs)
+                    if edicao is not None:
+                        self._registrar_renderizada(chave, edicao, data)
+                    break
+                except RetryAfter as e:
+                    espera = e.retry_after
+                    segundos = espera.total_seconds() if isinstance(espera, timedelta) else float(espera)
+                    self.stats['retry_after'] += 1
+                    if tentativa >= max_tentativas:
+                        raise
+                    logging.warning(f"RetryAfter em {endpoint} (chat {chat_id}): aguardando {segundos:.0f}s")
+                    (self._global if chat_id is None else self._balde_chat(chat_id)).pausar(segundos)
+            if edicao is not None:
+                edicao['futuro'].set_result(resultado)
+            return resultado
+        except BaseException as e:
+            # Mesmo conteúdo que já está na tela: o cache passa a refleti-lo
+            if (edicao is not None and not coalescida and isinstance(e, BadRequest)
+                    and 'message is not modified' in str(e).lower()):
+                self._registrar_renderizada(chave, edicao, data)
+            if edicao is not None and not edicao['futuro'].done():
+                edicao['futuro'].set_exception(e)
+            raise
+        finally:
+            if chave is not None and self._edicoes.get(chave) is edicao:
+                del self._edicoes[chave]
+            if chat_id is not None and self._chats.get(chat_id) and self._chats[chat_id].ocioso():
+                del self._chats[chat_id]
+
+agendador_telegram = AgendadorTelegram()
+
+def _escapar_label(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _formatar_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escapar_label(v)}"' for k, v in labels.items()) + '}'
+
+def _linhas_histograma(nome, labels, snapshot):
+    for limite, acumulado in snapshot['buckets']:
+        le = '+Inf' if limite == float('inf') else f'{limite:g}'
+        yield f"{nome}_bucket{_formatar_labels({**labels, 'le': le})} {acumulado}"
+    yield f"{nome}_sum{_formatar_labels(labels)} {snapshot['soma']}"
+    yield f"{nome}_count{_formatar_labels(labels)} {snapshot['total']}"
+
+def _metricas_processo():
+    uso = resource.getrusage(resource.RUSAGE_SELF)
+    metricas = {
+        'process_cpu_seconds_total': (uso.ru_utime + uso.ru_stime, 'Tempo de CPU (usuário + sistema) em segundos.'),
+        # ru_maxrss vem em KB no Linux
+        'process_max_resident_memory_bytes': (uso.ru_maxrss * 1024, 'Pico de memória residente em bytes.'),
+        'process_start_time_seconds': (_inicio_processo, 'Início do processo (epoch, segundos).'),
+    }
     try:
-        database_url = os.getenv("DATABASE_URL")
-        
-        if database_url:
-            conn = psycopg.connect(database_url)
-        else:
-            conn = psycopg.connect(
-                host=os.getenv("PGHOST"),
-                port=os.getenv("PGPORT", "5432"),
-                user=os.getenv("PGUSER"),
-                password=os.getenv("PGPASSWORD"),
-                dbname=os.getenv("PGDATABASE"),
-                sslmode="require"
-            )
-        
-        logging.info("Conexão com banco de dados estabelecida com sucesso")
-        return conn
-        
-    except Exception as e:
-        logging.error(f"Erro ao conectar com o banco de dados: {e}")
-        raise e
+        with open('/proc/self/statm') as statm:
+            paginas_residentes = int(statm.read().split()[1])
+        metricas['process_resident_memory_bytes'] = (
+            paginas_residentes * resource.getpagesize(), 'Memória residente atual em bytes.')
+    except (OSError, IndexError, ValueError):
+        pass
+    return metricas
+
+def gerar_metricas_prometheus():
+    """Gera todas as métricas no formato texto do Prometheus"""
+    linhas = []
+
+    def metrica(nome, tipo, ajuda):
+        linhas.append(f"# HELP {nome} {ajuda}")
+        linhas.append(f"# TYPE {nome} {tipo}")
+
+    with _metricas_lock:
+        handlers = {k: (v['latencia'].snapshot(), v['erros']) for k, v in _metricas_handlers.items()}
+        relatorios = {k: (v['latencia'].snapshot(), v['tamanho'].snapshot()) for k, v in _metricas_relatorios.items()}
+        telegram = {k: (v['latencia'].snapshot(), v['erros']) for k, v in _metricas_telegram.items()}
+    db = get_query_metrics()
+
+    metrica('financeiro_handler_duration_seconds', 'histogram', 'Latência dos handlers do bot por prefixo de callback/comando.')
+    for rotulo, (snapshot, _) in sorted(handlers.items()):
+        linhas.extend(_linhas_histograma('financeiro_handler_duration_seconds', {'handler': rotulo}, snapshot))
+    metrica('financeiro_handler_errors_total', 'counter', 'Exceções não tratadas nos handlers.')
+    for rotulo, (_, erros) in sorted(handlers.items()):
+        linhas.append(f"financeiro_handler_errors_total{_formatar_labels({'handler': rotulo})} {erros}")
+
+    metrica('financeiro_db_query_duration_seconds', 'histogram', 'Latência das queries por statement normalizado.')
+    for rotulo, dados in sorted(db['queries'].items()):
+        linhas.extend(_linhas_histograma('financeiro_db_query_duration_seconds', {'query': rotulo}, dados))
+    metrica('financeiro_db_query_rows_total', 'counter', 'Linhas retornadas/afetadas por statement.')
+    for rotulo, dados in sorted(db['queries'].items()):
+        linhas.append(f"financeiro_db_query_rows_total{_formatar_labels({'query': rotulo})} {dados['linhas']}")
+    metrica('financeiro_db_query_errors_total', 'counter', 'Erros por statement.')
+    for rotulo, dados in sorted(db['queries'].items()):
+        linhas.append(f"financeiro_db_query_errors_total{_formatar_labels({'query': rotulo})} {dados['erros']}")
+    metrica('financeiro_db_retries_total', 'counter', 'Tentativas repetidas por erro de conexão.')
+    linhas.append(f"financeiro_db_retries_total {db['retries']}")
+    # Reconexões vêm dos contadores do próprio psycopg_pool: conexões descartadas
+    # por falha (check ou erro) e conexões abertas para repô-las
+    metrica('financeiro_db_pool_connections_opened_total', 'counter', 'Conexões abertas pelos pools.')
+    for nome_pool in ('pool', 'pool_async'):
+        linhas.append(f"financeiro_db_pool_connections_opened_total{_formatar_labels({'pool': nome_pool})} "
+                      f"{db[nome_pool].get('connections_num', 0)}")
+    metrica('financeiro_db_pool_connections_lost_total', 'counter', 'Conexões descartadas pelos pools por falha.')
+    for nome_pool in ('pool', 'pool_async'):
+        linhas.append(f"financeiro_db_pool_connections_lost_total{_formatar_labels({'pool': nome_pool})} "
+                      f"{db[nome_pool].get('connections_lost', 0)}")
+    metrica('financeiro_db_pool_connections', 'gauge', 'Conexões nos pools (tamanho e disponíveis).')
+    for nome_pool in ('pool', 'pool_async'):
+        stats = db[nome_pool]
+        for chave in ('pool_size', 'pool_available', 'requests_waiting'):
+            if chave in stats:
+                linhas.append(
+                    f"financeiro_db_pool_connections{_formatar_labels({'pool': nome_pool, 'estado': chave})} {stats[chave]}")
+
+    metrica('financeiro_report_render_seconds', 'histogram', 'Tempo de renderização dos relatórios.')
+    for tipo, (latencia, _) in sorted(relatorios.items()):
+        linhas.extend(_linhas_histograma('financeiro_report_render_seconds', {'relatorio': tipo}, latencia))
+    metrica('financeiro_report_size_bytes', 'histogram', 'Tamanho dos relatórios gerados.')
+    for tipo, (_, tamanho) in sorted(relatorios.items()):
+        linhas.extend(_linhas_histograma('financeiro_report_size_bytes', {'relatorio': tipo}, tamanho))
+    cache = get_relatorios_cache_stats()
+    metrica('financeiro_report_cache_requests_total', 'counter', 'Consultas ao cache de relatórios por resultado.')
+    for resultado in ('hits', 'hits_disco', 'hits_file_id', 'misses'):
+        linhas.append(f"financeiro_report_cache_requests_total{_formatar_labels({'resultado': resultado})} {cache[resultado]}")
+    metrica('financeiro_report_cache_evictions_total', 'counter', 'Relatórios removidos do cache em memória por LRU.')
+    linhas.append(f"financeiro_report_cache_evictions_total {cache['remocoes']}")
+    metrica('financeiro_report_cache_bytes', 'gauge', 'Bytes ocupados pelo cache de relatórios em memória.')
+    linhas.append(f"financeiro_report_cache_bytes {cache['bytes']}")
+    categorias = get_categorias_cache_stats()
+    metrica('financeiro_category_cache_requests_total', 'counter', 'Consultas ao cache de categorias por resultado.')
+    for resultado in ('hits', 'misses'):
+        linhas.append(f"financeiro_category_cache_requests_total{_formatar_labels({'resultado': resultado})} {categorias[resultado]}")
+    metrica('financeiro_category_cache_invalidations_total', 'counter', 'Invalidações do cache de categorias.')
+    linhas.append(f"financeiro_category_cache_invalidations_total {categorias['invalidacoes']}")
+    metrica('financeiro_category_cache_entries', 'gauge', 'Tipos de categoria presentes no cache.')
+    linhas.append(f"financeiro_category_cache_entries {categorias['tipos_em_cache']}")
+
+    metrica('financeiro_telegram_request_duration_seconds', 'histogram', 'Latência das chamadas à Bot API.')
+    for metodo, (snapshot, _) in sorted(telegram.items()):
+        linhas.extend(_linhas_histograma('financeiro_telegram_request_duration_seconds', {'metodo': metodo}, snapshot))
+    metrica('financeiro_telegram_request_errors_total', 'counter', 'Chamadas à Bot API com erro.')
+    for metodo, (_, erros) in sorted(telegram.items()):
+        linhas.append(f"financeiro_telegram_request_errors_total{_formatar_labels({'metodo': metodo})} {erros}")
+
+    saude = snapshot_saude()
+    metrica('financeiro_health_up', 'gauge', 'Resultado da última sonda de saúde (1 = ok).')
+    linhas.append(f"financeiro_health_up{_formatar_labels({'componente': 'database'})} {int(saude['database'] == 'healthy')}")
+    linhas.append(f"financeiro_health_up{_formatar_labels({'componente': 'bot'})} {int(saude['bot'] == 'running')}")
+    if saude['probe_latency_ms'] is not None:
+        metrica('financeiro_health_probe_latency_seconds', 'gauge', 'Latência da última sonda do banco.')
+        linhas.append(f"financeiro_health_probe_latency_seconds {saude['probe_latency_ms'] / 1000:.4f}")
+    if saude['age_seconds'] is not None:
+        metrica('financeiro_health_age_seconds', 'gauge', 'Segundos desde a última sonda de saúde.')
+        linhas.append(f"financeiro_health_age_seconds {saude['age_seconds']}")
+
+    fila = agendador_telegram.profundidade()
+    metrica('financeiro_telegram_queue_depth', 'gauge', 'Chamadas à Bot API aguardando o rate limiter.')
+    for balde in ('global', 'chat'):
+        linhas.append(f"financeiro_telegram_queue_depth{_formatar_labels({'balde': balde})} {fila[balde]}")
+    metrica('financeiro_telegram_queued_chats', 'gauge', 'Chats com chamadas aguardando o rate limiter.')
+    linhas.append(f"financeiro_telegram_queued_chats {fila['chats_com_fila']}")
+    metrica('financeiro_telegram_coalesced_edits_total', 'counter', 'Edições descartadas por uma edição mais nova da mesma mensagem.')
+    linhas.append(f"financeiro_telegram_coalesced_edits_total {agendador_telegram.stats['coalescidas']}")
+    metrica('financeiro_telegram_retry_after_total', 'counter', 'Respostas RetryAfter (429) recebidas da Bot API.')
+    linhas.append(f"financeiro_telegram_retry_after_total {agendador_telegram.stats['retry_after']}")
+    metrica('financeiro_telegram_throttle_seconds_total', 'counter', 'Tempo total de espera imposto pelo rate limiter.')
+    linhas.append(f"financeiro_telegram_throttle_seconds_total {agendador_telegram.stats['espera_segundos']:.3f}")
+    metrica('financeiro_telegram_edits_skipped_total', 'counter', 'Edições sem mudança de conteúdo, por motivo.')
+    for motivo, total in sorted(_mensagens_stats.items()):
+        linhas.append(f"financeiro_telegram_edits_skipped_total{_formatar_labels({'motivo': motivo})} {total}")
+
+    for nome, (valor, ajuda) in _metricas_processo().items():
+        metrica(nome, 'counter' if nome.endswith('_total') else 'gauge', ajuda)
+        linhas.append(f"{nome} {valor}")
+
+    return '\n'.join(linhas) + '\n'
+
+def _contar_linhas(result, fetch):
+    if fetch:
+        return len(result)
+    if isinstance(result, int):
+        return result
+    return 1 if result else 0
 
-conn = None
+# --- CONEXÃO COM O BANCO DE DADOS ---
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "5"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_RETRY_BACKOFF = float(os.getenv("DB_RETRY_BACKOFF", "0.5"))
+DB_RETRY_BACKOFF_MAX = float(os.getenv("DB_RETRY_BACKOFF_MAX", "8"))
+
+def get_conninfo():
+    """Retorna a string e os parâmetros de conexão a partir das variáveis de ambiente"""
+    database_url = os.getenv("DATABASE_URL")
+
+    if database_url:
+        return database_url, {}
+
+    return "", {
+        "host": os.getenv("PGHOST"),
+        "port": os.getenv("PGPORT", "5432"),
+        "user": os.getenv("PGUSER"),
+        "password": os.getenv("PGPASSWORD"),
+        "dbname": os.getenv("PGDATABASE"),
+        "sslmode": "require",
+    }
 
-def init_database():
-    """Inicializa a conexão com o banco de dados"""
-    global conn
-    conn = get_connection()
+pool = None
 
-def execute_with_retry(query, params=None, fetch=False):
+def init_database():
+    """Inicializa o pool de conexões com o banco de dados"""
+    global pool
+    conninfo, kwargs = get_conninfo()
+    pool = ConnectionPool(
+        conninfo,
+        kwargs=kwargs,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=max(DB_POOL_MAX_SIZE, DB_POOL_MIN_SIZE),
+        timeout=DB_POOL_TIMEOUT,
+        # Valida a conexão antes de entregá-la, descartando as que caíram
+        check=ConnectionPool.check_connection,
+        # O pool reconecta em segundo plano com backoff exponencial
+        reconnect_timeout=DB_POOL_TIMEOUT * 10,
+        name="financeiro",
+        open=False)
+    pool.open(wait=True, timeout=DB_POOL_TIMEOUT)
+    logging.info(
+        f"Pool de conexões aberto (min={pool.min_size}, max={pool.max_size})")
+
+def close_database():
+    """Fecha o pool de conexões, se estiver aberto"""
+    global pool
+    if pool is not None:
+        pool.close()
+        pool = None
+
+def _retry_delay(attempt):
+    """Tempo de espera (backoff exponencial) antes da próxima tentativa"""
+    return min(DB_RETRY_BACKOFF * (2 ** attempt), DB_RETRY_BACKOFF_MAX)
+
+def execute_with_retry(query, params=None, fetch=False, label=None):
     """Executa uma query com retry automático em caso de conexão perdida"""
-    global conn
     max_retries = 3
+    rotulo = label or rotulo_query(query)
     
     for attempt in range(max_retries):
+        inicio = time.perf_counter()
         try:
-            if conn.closed:
-                conn = get_connection()
-                
-            with conn.cursor() as cur:
-                cur.execute(query, params)
-                if fetch:
-                    return cur.fetchall()
-                else:
-                    result = None
-                    if query.strip().upper().startswith(('INSERT', 'UPDATE', 'DELETE')):
-                        if 'RETURNING' in query.upper():
-                            result = cur.fetchone()
-                        else:
-                            result = cur.rowcount
-                    conn.commit()
-                    return result
+            # Cada chamada pega sua própria conexão do pool; o commit
+            # acontece ao devolvê-la, e conexões quebradas são descartadas.
+            with pool.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(query, params)
+                    if fetch:
+                        result = cur.fetchall()
+                    else:
+                        result = None
+                        if query.strip().upper().startswith(('INSERT', 'UPDATE', 'DELETE')):
+                            if 'RETURNING' in query.upper():
+                                result = cur.fetchone()
+                            else:
+                                result = cur.rowcount
+            registrar_query(rotulo, time.perf_counter() - inicio, _contar_linhas(result, fetch))
+            return result
                     
-        except (psycopg.OperationalError, psycopg.InterfaceError) as e:
+        except (psycopg.OperationalError, psycopg.InterfaceError, PoolTimeout) as e:
             logging.warning(f"Erro de conexão (tentativa {attempt + 1}/{max_retries}): {e}")
+            registrar_erro_query(rotulo, retry=attempt < max_retries - 1)
             if attempt < max_retries - 1:
-                try:
-                    conn.close()
-                except:
-                    pass
-                conn = get_connection()
+                # Força o pool a verificar as conexões ociosas antes de tentar de novo
+                pool.check()
+                time.sleep(_retry_delay(attempt))
             else:
                 raise e
         except Exception as e:
             logging.error(f"Erro na execução da query: {e}")
+            registrar_erro_query(rotulo)
             raise e
 
+# --- ACESSO ASSÍNCRONO (USADO PELOS HANDLERS DO BOT) ---
+async_pool = None
+
+async def init_database_async():
+    """Abre o pool assíncrono no event loop do bot"""
+    global async_pool
+    conninfo, kwargs = get_conninfo()
+    async_pool = AsyncConnectionPool(
+        conninfo,
+        kwargs=kwargs,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=max(DB_POOL_MAX_SIZE, DB_POOL_MIN_SIZE),
+        timeout=DB_POOL_TIMEOUT,
+        check=AsyncConnectionPool.check_connection,
+        reconnect_timeout=DB_POOL_TIMEOUT * 10,
+        name="financeiro-async",
+        open=False)
+    await async_pool.open(wait=True, timeout=DB_POOL_TIMEOUT)
+    logging.info(
+        f"Pool assíncrono aberto (min={async_pool.min_size}, max={async_pool.max_size})")
+
+async def close_database_async():
+    """Fecha o pool assíncrono, se estiver aberto"""
+    global async_pool
+    if async_pool is not None:
+        await async_pool.close()
+        async_pool = None
+
+async def execute_with_retry_async(query, params=None, fetch=False, label=None):
+    """Versão assíncrona de execute_with_retry, sem bloquear o event loop"""
+    max_retries = 3
+    rotulo = label or rotulo_query(query)
+
+    for attempt in range(max_retries):
+        inicio = time.perf_counter()
+        try:
+            async with async_pool.connection() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(query, params)
+                    if fetch:
+                        result = await cur.fetchall()
+                    else:
+                        result = None
+                        if query.strip().upper().startswith(('INSERT', 'UPDATE', 'DELETE')):
+                            if 'RETURNING' in query.upper():
+                                result = await cur.fetchone()
+                            else:
+                                result = cur.rowcount
+            registrar_query(rotulo, time.perf_counter() - inicio, _contar_linhas(result, fetch))
+            return result
+
+        except (psycopg.OperationalError, psycopg.InterfaceError, PoolTimeout) as e:
+            logging.warning(f"Erro de conexão (tentativa {attempt + 1}/{max_retries}): {e}")
+            registrar_erro_query(rotulo, retry=attempt < max_retries - 1)
+            if attempt < max_retries - 1:
+                await async_pool.check()
+                await asyncio.sleep(_retry_delay(attempt))
+            else:
+                raise e
+        except Exception as e:
+            logging.error(f"Erro na execução da query: {e}")
+            registrar_erro_query(rotulo)
+            raise e
+
+async def fetch_dataframe_async(query, params=None):
+    """Executa uma consulta no pool assíncrono e devolve o resultado como DataFrame"""
+    await carregar_analise_async()
+    rotulo = rotulo_query(query)
+    inicio = time.perf_counter()
+    try:
+        async with async_pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, params)
+                rows = await cur.fetchall()
+                columns = [col.name for col in cur.description]
+    except Exception:
+        registrar_erro_query(rotulo)
+        raise
+    registrar_query(rotulo, time.perf_counter() - inicio, len(rows))
+    # coerce_float mantém o mesmo comportamento do pd.read_sql_query (Decimal -> float)
+    return pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+
 def setup_database():
     """Configura as tabelas do banco de dados"""
     queries = [
@@ -133,9 +808,18 @@ def setup_database():
             valor DECIMAL(10, 2),
             descricao TEXT,
             data DATE,
-            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            categoria_principal TEXT,
+            subcategoria TEXT
         );
         """,
+        # Migração: colunas normalizadas de categoria em bancos já existentes
+        # (sem DEFAULT, o ADD COLUMN não reescreve a tabela)
+        """
+        ALTER TABLE transacoes
+            ADD COLUMN IF NOT EXISTS categoria_principal TEXT,
+            ADD COLUMN IF NOT EXISTS subcategoria TEXT;
+        """,
         """
         CREATE TABLE IF NOT EXISTS orcamentos (
             id SERIAL PRIMARY KEY,
@@ -153,12 +837,128 @@ def setup_database():
             tipo TEXT,
             icone TEXT
         );
+        """,
+        # Índices para os filtros por mês (intervalos de data semiabertos)
+        """
+        CREATE INDEX IF NOT EXISTS idx_transacoes_data_tipo
+            ON transacoes (data, tipo);
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_transacoes_principal_data
+            ON transacoes (categoria_principal, data);
+        """,
+        # Resumo mensal pré-agregado, mantido pelos triggers abaixo
+        """
+        CREATE TABLE IF NOT EXISTS resumo_mensal (
+            ano INTEGER NOT NULL,
+            mes INTEGER NOT NULL,
+            categoria TEXT NOT NULL,
+            tipo TEXT NOT NULL,
+            total DECIMAL(14, 2) NOT NULL DEFAULT 0,
+            quantidade INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (ano, mes, categoria, tipo)
+        );
+        """,
+        # Versão dos dados de cada mês, usada como chave do cache de relatórios
+        """
+        CREATE TABLE IF NOT EXISTS versao_mes (
+            ano INTEGER NOT NULL,
+            mes INTEGER NOT NULL,
+            versao BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (ano, mes)
+        );
+        """,
+        # Mantém resumo_mensal e versao_mes uma vez por comando, a partir das
+        # tabelas de transição: cargas em lote (importação, zerar) custam um
+        # upsert por chave em vez de um por linha
+        """
+        CREATE OR REPLACE FUNCTION transacoes_agregados_trigger() RETURNS TRIGGER AS $$
+        DECLARE
+            v_delta TEXT;
+        BEGIN
+            -- Linhas afetadas com sinal: +1 para as novas, -1 para as antigas
+            v_delta := CASE TG_OP
+                WHEN 'INSERT' THEN
+                    'SELECT data, categoria_principal, categoria, tipo, valor, 1 AS sinal FROM novas'
+                WHEN 'DELETE' THEN
+                    'SELECT data, categoria_principal, categoria, tipo, valor, -1 AS sinal FROM antigas'
+                ELSE
+                    'SELECT data, categoria_principal, categoria, tipo, valor, 1 AS sinal FROM novas
+                     UNION ALL
+                     SELECT data, categoria_principal, categoria, tipo, valor, -1 FROM antigas'
+            END;
+
+            -- "Cartão X - Sub" é agregado em "Cartão X"; o SPLIT_PART só é usado
+            -- para linhas que ainda não passaram pela migração
+            EXECUTE format($sql$
+                WITH delta AS (%s),
+                agregado AS (
+                    SELECT EXTRACT(YEAR FROM data)::INTEGER AS ano,
+                           EXTRACT(MONTH FROM data)::INTEGER AS mes,
+                           COALESCE(categoria_principal, NULLIF(SPLIT_PART(categoria, ' - ', 1), ''),
+                                    categoria, '') AS categoria,
+                           COALESCE(tipo, '') AS tipo,
+                           SUM(sinal * COALESCE(valor, 0)) AS total,
+                           SUM(sinal) AS quantidade
+                    FROM delta
+                    WHERE data IS NOT NULL
+                    GROUP BY 1, 2, 3, 4
+                    -- updates que não mudam o agregado (descrição, migração) se anulam
+                    HAVING SUM(sinal) <> 0 OR SUM(sinal * COALESCE(valor, 0)) <> 0
+                ),
+                versoes AS (
+                    INSERT INTO versao_mes AS v (ano, mes, versao)
+                    SELECT DISTINCT EXTRACT(YEAR FROM data)::INTEGER, EXTRACT(MONTH FROM data)::INTEGER, 1
+                    FROM delta
+                    WHERE data IS NOT NULL
+                    ON CONFLICT (ano, mes) DO UPDATE SET versao = v.versao + 1
+                )
+                INSERT INTO resumo_mensal AS r (ano, mes, categoria, tipo, total, quantidade)
+                SELECT ano, mes, categoria, tipo, total, quantidade FROM agregado
+                ON CONFLICT (ano, mes, categoria, tipo) DO UPDATE
+                    SET total = r.total + EXCLUDED.total,
+                        quantidade = r.quantidade + EXCLUDED.quantidade
+            $sql$, v_delta);
+
+            IF TG_OP <> 'INSERT' THEN
+                DELETE FROM resumo_mensal WHERE quantidade <= 0;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        """
+        DROP TRIGGER IF EXISTS trg_transacoes_agregados_ins ON transacoes;
+        CREATE TRIGGER trg_transacoes_agregados_ins
+            AFTER INSERT ON transacoes REFERENCING NEW TABLE AS novas
+            FOR EACH STATEMENT EXECUTE FUNCTION transacoes_agregados_trigger();
+        """,
+        """
+        DROP TRIGGER IF EXISTS trg_transacoes_agregados_upd ON transacoes;
+        CREATE TRIGGER trg_transacoes_agregados_upd
+            AFTER UPDATE ON transacoes REFERENCING OLD TABLE AS antigas NEW TABLE AS novas
+            FOR EACH STATEMENT EXECUTE FUNCTION transacoes_agregados_trigger();
+        """,
+        """
+        DROP TRIGGER IF EXISTS trg_transacoes_agregados_del ON transacoes;
+        CREATE TRIGGER trg_transacoes_agregados_del
+            AFTER DELETE ON transacoes REFERENCING OLD TABLE AS antigas
+            FOR EACH STATEMENT EXECUTE FUNCTION transacoes_agregados_trigger();
         """
     ]
     
     for query in queries:
         execute_with_retry(query)
     
+    migrar_categorias_transacoes()
+    
+    # Preenche o resumo mensal na primeira execução com dados já existentes
+    resumo_result = execute_with_retry(
+        "SELECT EXISTS (SELECT 1 FROM resumo_mensal), EXISTS (SELECT 1 FROM transacoes)", fetch=True)
+    resumo_preenchido, tem_transacoes = resumo_result[0]
+    if tem_transacoes and not resumo_preenchido:
+        rebuild_resumo_mensal()
+    
     # Inserir categorias padrão se não existirem
     count_result = execute_with_retry("SELECT COUNT(*) FROM categorias", fetch=True)
     if count_result[0][0] == 0:
@@ -185,188 +985,516 @@ def setup_database():
                 'INSERT INTO categorias (nome, tipo, icone) VALUES (%s, %s, %s)',
                 categoria
             )
+        invalidar_cache_categorias()
+
+def rebuild_resumo_mensal():
+    """Recalcula toda a tabela resumo_mensal a partir de 'transacoes'"""
+    with pool.connection() as conn:
+        with conn.transaction():
+            # Bloqueia escritas concorrentes (leituras continuam liberadas)
+            conn.execute("LOCK TABLE transacoes IN SHARE MODE")
+            conn.execute("DELETE FROM resumo_mensal")
+            cur = conn.execute("""
+                INSERT INTO resumo_mensal (ano, mes, categoria, tipo, total, quantidade)
+                SELECT 
+                    EXTRACT(YEAR FROM data)::INTEGER,
+                    EXTRACT(MONTH FROM data)::INTEGER,
+                    COALESCE(categoria_principal, NULLIF(SPLIT_PART(categoria, ' - ', 1), ''), categoria, ''),
+                    COALESCE(tipo, ''),
+                    COALESCE(SUM(valor), 0),
+                    COUNT(*)
+                FROM transacoes
+                WHERE data IS NOT NULL
+                GROUP BY 1, 2, 3, 4
+            """)
+            linhas = cur.rowcount
+    logging.info(f"Resumo mensal reconstruído ({linhas} linhas)")
+    return linhas
+
+def separar_categoria(categoria):
+    """Separa "Cartão X - SUB" em (categoria principal, subcategoria)"""
+    principal, separador, subcategoria = (categoria or '').partition(' - ')
+    if not separador or not principal:
+        return categoria, None
+    return principal, subcategoria
+
+# Preenche categoria_principal/subcategoria das linhas antigas em lotes pequenos,
+# para não segurar locks na tabela inteira enquanto o bot está no ar
+SQL_MIGRAR_CATEGORIAS = """
+    UPDATE transacoes SET
+        categoria_principal = COALESCE(NULLIF(SPLIT_PART(categoria, ' - ', 1), ''), categoria),
+        subcategoria = CASE
+            WHEN POSITION(' - ' IN categoria) > 1
+            THEN SUBSTRING(categoria FROM POSITION(' - ' IN categoria) + 3)
+        END
+    WHERE id IN (
+        SELECT id FROM transacoes
+        WHERE categoria_principal IS NULL AND categoria IS NOT NULL
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    )
+"""
+
+def migrar_categorias_transacoes(lote=1000):
+    """Migra as transações antigas para as colunas normalizadas de categoria"""
+    total = 0
+    while True:
+        migradas = execute_with_retry(SQL_MIGRAR_CATEGORIAS, (lote,))
+        if not migradas:
+            break
+        total += migradas
+    if total:
+        logging.info(f"{total} transações migradas para categoria_principal/subcategoria")
+    return total
+
+def get_intervalo_mes(mes, ano):
+    """Retorna o intervalo semiaberto [primeiro dia, primeiro dia do mês seguinte)"""
+    inicio = date(ano, mes, 1)
+    return inicio, inicio + relativedelta(months=1)
+
+async def zerar_dados_async():
+    await execute_with_retry_async("DELETE FROM transacoes")
+    await execute_with_retry_async("DELETE FROM orcamentos")
+
+SQL_CATEGORIAS_POR_TIPO = "SELECT nome, icone FROM categorias WHERE tipo = %s OR tipo = 'ambos' ORDER BY nome"
+SQL_CATEGORIAS = "SELECT nome, icone FROM categorias ORDER BY nome"
+
+# --- CACHE DE CATEGORIAS ---
+# A tabela 'categorias' quase nunca muda: o catálogo fica em memória, por tipo,
+# e qualquer código que altere categorias deve chamar invalidar_cache_categorias().
+TIPOS_CATEGORIA = [None, 'receita', 'despesa']
+
+_categorias_cache = {}
+_categorias_cache_lock = threading.Lock()
+_categorias_cache_stats = {'hits': 0, 'misses': 0, 'invalidacoes': 0}
+
+def _categorias_do_cache(tipo):
+    with _categorias_cache_lock:
+        if tipo in _categorias_cache:
+            _categorias_cache_stats['hits'] += 1
+            return _categorias_cache[tipo]
+        _categorias_cache_stats['misses'] += 1
+        return None
 
-def zerar_dados():
-    execute_with_retry("DELETE FROM transacoes")
-    execute_with_retry("DELETE FROM orcamentos")
+def _guardar_categorias(tipo, categorias):
+    with _categorias_cache_lock:
+        _categorias_cache[tipo] = categorias
+    return categorias
 
-def get_categorias(tipo=None):
+def invalidar_cache_categorias():
+    """Descarta o catálogo de categorias em memória"""
+    with _categorias_cache_lock:
+        _categorias_cache.clear()
+        _categorias_cache_stats['invalidacoes'] += 1
+
+def carregar_categorias():
+    """Carrega o catálogo de categorias de todos os tipos (usado na inicialização)"""
+    for tipo in TIPOS_CATEGORIA:
+        _guardar_categorias(tipo, _buscar_categorias(tipo))
+
+def get_categorias_cache_stats():
+    """Retorna os contadores de acerto/falha do cache de categorias"""
+    with _categorias_cache_lock:
+        return {**_categorias_cache_stats, 'tipos_em_cache': len(_categorias_cache)}
+
+def _buscar_categorias(tipo):
     if tipo:
-        query = "SELECT nome, icone FROM categorias WHERE tipo = %s OR tipo = 'ambos' ORDER BY nome"
-        return execute_with_retry(query, (tipo,), fetch=True)
+        return execute_with_retry(SQL_CATEGORIAS_POR_TIPO, (tipo,), fetch=True)
     else:
-        query = "SELECT nome, icone FROM categorias ORDER BY nome"
-        return execute_with_retry(query, fetch=True)
+        return execute_with_retry(SQL_CATEGORIAS, fetch=True)
 
-def add_transacao(user_id, tipo, categoria, valor, descricao, data):
-    query = """
-        INSERT INTO transacoes (user_id, tipo, categoria, valor, descricao, data) 
-        VALUES (%s, %s, %s, %s, %s, %s) RETURNING id
-    """
-    result = execute_with_retry(query, (user_id, tipo, categoria, float(valor), descricao, data))
-    return result[0] if result else None
+async def get_categorias_async(tipo=None):
+    categorias = _categorias_do_cache(tipo)
+    if categorias is not None:
+        return categorias
+    if tipo:
+        categorias = await execute_with_retry_async(SQL_CATEGORIAS_POR_TIPO, (tipo,), fetch=True)
+    else:
+        categorias = await execute_with_retry_async(SQL_CATEGORIAS, fetch=True)
+    return _guardar_categorias(tipo, categorias)
+
+# Colunas na ordem em que os handlers desempacotam a transação
+COLUNAS_TRANSACAO = "id, user_id, tipo, categoria, valor, descricao, data, created_at"
+
+# As escritas devolvem a linha completa (RETURNING), evitando reler a transação
+SQL_INSERT_TRANSACAO = f"""
+    INSERT INTO transacoes (user_id, tipo, categoria, categoria_principal, subcategoria, valor, descricao, data) 
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING {COLUNAS_TRANSACAO}
+"""
+
+def _params_insert_transacao(user_id, tipo, categoria, valor, descricao, data):
+    principal, subcategoria = separar_categoria(categoria)
+    return (user_id, tipo, categoria, principal, subcategoria, float(valor), descricao, data)
+
+async def add_transacao_async(user_id, tipo, categoria, valor, descricao, data):
+    """Insere a transação e retorna a linha gravada"""
+    return await execute_with_retry_async(
+        SQL_INSERT_TRANSACAO, _params_insert_transacao(user_id, tipo, categoria, valor, descricao, data))
 
 # NOVA FUNÇÃO: Exclui uma transação pelo ID
-def delete_transacao(tx_id):
+async def delete_transacao_async(tx_id):
     """Exclui uma transação da tabela 'transacoes'."""
     query = "DELETE FROM transacoes WHERE id = %s"
-    return execute_with_retry(query, (tx_id,))
+    return await execute_with_retry_async(query, (tx_id,))
 
-def get_orcamento_status(categoria, mes, ano):
-    orcamento_result = execute_with_retry(
-        'SELECT valor_limite FROM orcamentos WHERE categoria = %s AND mes = %s AND ano = %s',
-        (categoria, mes, ano), fetch=True
-    )
-    
-    if not orcamento_result:
-        return None, 0, 0, 0
-    
-    limite = orcamento_result[0][0]
-    
-    # ATENÇÃO: A busca por despesas no orçamento DEVE AGREGAR as subcategorias de cartão
-    
-    # 1. Tenta buscar pelo nome exato (para categorias normais)
-    gasto_result_exact = execute_with_retry(
-        "SELECT COALESCE(SUM(valor), 0) FROM transacoes WHERE categoria = %s AND tipo = 'despesa' AND EXTRACT(YEAR FROM data) = %s AND EXTRACT(MONTH FROM data) = %s",
-        (categoria, ano, mes), fetch=True
-    )
-    gasto_atual = gasto_result_exact[0][0] if gasto_result_exact else 0
-    
-    # 2. Se a categoria for um Cartão Especial, soma também as subcategorias (Cartão X - Sub)
-    if categoria in CARTOES_ESPECIAIS:
-        gasto_result_sub = execute_with_retry(
-            "SELECT COALESCE(SUM(valor), 0) FROM transacoes WHERE categoria LIKE %s AND categoria != %s AND tipo = 'despesa' AND EXTRACT(YEAR FROM data) = %s AND EXTRACT(MONTH FROM data) = %s",
-            (f"{categoria} - %", categoria, ano, mes), fetch=True
-        )
-        # O valor exato já foi contado acima. Se o lançamento for "Cartão NUBANK", ele já está no gasto_atual.
-        # Aqui, somamos APENAS as subcategorias ("Cartão NUBANK - LANCHES").
-        gasto_atual += gasto_result_sub[0][0] if gasto_result_sub else 0
+SQL_ORCAMENTO_LIMITE = 'SELECT valor_limite FROM orcamentos WHERE categoria = %s AND mes = %s AND ano = %s'
+# A busca por categoria_principal já agrega as subcategorias de cartão ("Cartão X - Sub")
+SQL_GASTO_CATEGORIA = "SELECT COALESCE(SUM(valor), 0) FROM transacoes WHERE categoria_principal = %s AND tipo = 'despesa' AND data >= %s AND data < %s"
 
+def _calcular_orcamento_status(limite, gasto_atual):
     disponivel = limite - gasto_atual
     percentual_usado = (gasto_atual / limite) * 100 if limite > 0 else 0
     
     return limite, gasto_atual, disponivel, percentual_usado
 
-def set_orcamento(categoria, valor_limite, mes, ano):
-    query = """
-        INSERT INTO orcamentos (categoria, valor_limite, mes, ano) 
-        VALUES (%s, %s, %s, %s) 
-        ON CONFLICT(categoria, mes, ano) 
-        DO UPDATE SET valor_limite = excluded.valor_limite
-    """
-    execute_with_retry(query, (float(valor_limite), mes, ano))
+async def get_orcamento_status_async(categoria, mes, ano):
+    orcamento_result = await execute_with_retry_async(SQL_ORCAMENTO_LIMITE, (categoria, mes, ano), fetch=True)
 
-def get_todos_orcamentos(mes, ano):
-    query = "SELECT categoria, valor_limite FROM orcamentos WHERE mes = %s AND ano = %s ORDER BY categoria"
-    return execute_with_retry(query, (mes, ano), fetch=True)
+    if not orcamento_result:
+        return None, 0, 0, 0
 
-def get_transacoes_por_categoria(categoria, mes, ano):
+    limite = orcamento_result[0][0]
+    inicio, fim = get_intervalo_mes(mes, ano)
+
+    gasto_result = await execute_with_retry_async(SQL_GASTO_CATEGORIA, (categoria, inicio, fim), fetch=True)
+    gasto_atual = gasto_result[0][0] if gasto_result else 0
+
+    return _calcular_orcamento_status(limite, gasto_atual)
+
+SQL_SET_ORCAMENTO = """
+    INSERT INTO orcamentos (categoria, valor_limite, mes, ano) 
+    VALUES (%s, %s, %s, %s) 
+    ON CONFLICT(categoria, mes, ano) 
+    DO UPDATE SET valor_limite = excluded.valor_limite
+"""
+
+async def set_orcamento_async(categoria, valor_limite, mes, ano):
+    await execute_with_retry_async(SQL_SET_ORCAMENTO, (categoria, float(valor_limite), mes, ano))
+
+# Status de todos os orçamentos do mês em uma única consulta agregada.
+# Cartões especiais somam também as subcategorias ("Cartão X - Sub") via categoria_principal.
+SQL_ORCAMENTOS_STATUS = """
+    SELECT o.categoria, o.valor_limite, COALESCE(SUM(t.valor), 0) AS gasto
+    FROM orcamentos o
+    LEFT JOIN transacoes t
+        ON t.tipo = 'despesa'
+        AND t.data >= %s AND t.data < %s
+        AND t.categoria_principal = o.categoria
+    WHERE o.mes = %s AND o.ano = %s
+    GROUP BY o.categoria, o.valor_limite
+    ORDER BY o.categoria
+"""
+
+def _params_orcamentos_status(mes, ano):
+    inicio, fim = get_intervalo_mes(mes, ano)
+    return (inicio, fim, mes, ano)
+
+def _montar_orcamentos_status(rows):
+    # Cada item: (categoria, limite, gasto, disponivel, percentual_usado)
+    return [(categoria, *_calcular_orcamento_status(limite, gasto)) for categoria, limite, gasto in rows]
+
+async def get_orcamentos_status_async(mes, ano):
+    rows = await execute_with_retry_async(
+        SQL_ORCAMENTOS_STATUS, _params_orcamentos_status(mes, ano), fetch=True)
+    return _montar_orcamentos_status(rows)
+
+def _query_transacoes_por_categoria(categoria, mes, ano):
     # Nesta função, queremos ver TODAS as transações relacionadas à categoria principal,
     # incluindo as subcategorias, para uma visualização completa do gasto.
-    
-    if categoria in CARTOES_ESPECIAIS:
-        # Usa LIKE para incluir a categoria principal e todas as subcategorias
-        query = """
-            SELECT data, descricao, valor FROM transacoes 
-            WHERE categoria LIKE %s AND tipo = 'despesa' 
-            AND EXTRACT(YEAR FROM data) = %s AND EXTRACT(MONTH FROM data) = %s 
-            ORDER BY data
-        """
-        # A busca por "Cartão X%" pega "Cartão X" e "Cartão X - Sub"
-        return execute_with_retry(query, (f"{categoria}%", ano, mes), fetch=True)
-    else:
-        # Busca normal por nome exato para outras categorias
-        query = """
-            SELECT data, descricao, valor FROM transacoes 
-            WHERE categoria = %s AND tipo = 'despesa' 
-            AND EXTRACT(YEAR FROM data) = %s AND EXTRACT(MONTH FROM data) = %s 
-            ORDER BY data
-        """
-        return execute_with_retry(query, (categoria, ano, mes), fetch=True)
+    inicio, fim = get_intervalo_mes(mes, ano)
+    query = """
+        SELECT data, descricao, valor FROM transacoes 
+        WHERE categoria_principal = %s AND tipo = 'despesa' 
+        AND data >= %s AND data < %s 
+        ORDER BY data
+    """
+    return query, (categoria, inicio, fim)
 
-def gerar_relatorio_mensal(mes, ano, detalhado=False):
-    global conn
+async def get_transacoes_por_categoria_async(categoria, mes, ano):
+    query, params = _query_transacoes_por_categoria(categoria, mes, ano)
+    return await execute_with_retry_async(query, params, fetch=True)
+
+def _query_relatorio_mensal(mes, ano):
+    # Relatório Resumido: lê o resumo_mensal, em que as subcategorias de
+    # cartão já estão agregadas na categoria principal pelos triggers
+    query = """
+        SELECT categoria, tipo, total 
+        FROM resumo_mensal 
+        WHERE ano = %s AND mes = %s
+    """
+    return query, [ano, mes]
+
+async def gerar_relatorio_mensal_async(mes, ano):
+    await carregar_analise_async()
     try:
-        if conn.closed:
-            conn = get_connection()
-            
-        if detalhado:
-            # Relatório Detalhado: Usa a categoria como está no banco (inclui subcategorias)
-            query = """
-                SELECT data, categoria, descricao, tipo, valor, user_id 
-                FROM transacoes 
-                WHERE EXTRACT(YEAR FROM data) = %s AND EXTRACT(MONTH FROM data) = %s 
-                ORDER BY data
-            """
-        else:
-            # Relatório Resumido: Agrupa subcategorias de cartão na principal
-            # Usando uma função SQL para determinar a categoria para agrupamento
-            query = f"""
-                SELECT 
-                    COALESCE(
-                        NULLIF(
-                            SPLIT_PART(categoria, ' - ', 1),
-                            ''
-                        ), categoria
-                    ) AS categoria_agregada, 
-                    tipo, 
-                    SUM(valor) as total 
-                FROM transacoes 
-                WHERE EXTRACT(YEAR FROM data) = %s AND EXTRACT(MONTH FROM data) = %s 
-                GROUP BY categoria_agregada, tipo
-            """
-        
-        df = pd.read_sql_query(query, conn, params=[ano, mes])
-        
-        # Renomeia a coluna no DataFrame para 'categoria' se for o relatório resumido
-        if not detalhado and 'categoria_agregada' in df.columns:
-            df.rename(columns={'categoria_agregada': 'categoria'}, inplace=True)
-            
-        return df
-        
+        query, params = _query_relatorio_mensal(mes, ano)
+        return await fetch_dataframe_async(query, params)
+
     except Exception as e:
         logging.error(f"Erro ao gerar relatório: {e}")
         return pd.DataFrame()
 
-def get_ultimos_lancamentos(limit=7):
-    query = """
-        SELECT id, data, tipo, categoria, descricao, valor, user_id 
-        FROM transacoes 
-        ORDER BY id DESC LIMIT %s
+DETALHADO_LOTE = int(os.getenv("DETALHADO_LOTE", "500"))
+
+SQL_TRANSACOES_DETALHADO = """
+    SELECT data, tipo, categoria, descricao, valor
+    FROM transacoes
+    WHERE data >= %s AND data < %s
+    ORDER BY tipo DESC, data, id
+"""
+
+async def iterar_transacoes_mes_async(mes, ano, lote=DETALHADO_LOTE):
+    """Percorre as transações do mês com um cursor no servidor, entregando lotes de linhas"""
+    rotulo = rotulo_query(SQL_TRANSACOES_DETALHADO)
+    inicio = time.perf_counter()
+    linhas = 0
+    try:
+        async with async_pool.connection() as conn:
+            async with conn.cursor(name='transacoes_detalhado') as cur:
+                await cur.execute(SQL_TRANSACOES_DETALHADO, get_intervalo_mes(mes, ano))
+                while rows := await cur.fetchmany(lote):
+                    linhas += len(rows)
+                    yield rows
+    except Exception:
+        registrar_erro_query(rotulo)
+        raise
+    registrar_query(rotulo, time.perf_counter() - inicio, linhas)
+
+# Exportação: lida em lotes de EXPORTACAO_LOTE linhas (XLSX) e montada num arquivo
+# temporário que fica em memória até EXPORTACAO_SPOOL_BYTES
+EXPORTACAO_LOTE = int(os.getenv("EXPORTACAO_LOTE", "500"))
+EXPORTACAO_SPOOL_BYTES = 1024 * 1024
+
+# As datas entram como literais porque COPY não aceita parâmetros
+COLUNAS_EXPORTACAO = ("id", "data", "tipo", "categoria", "categoria_principal", "subcategoria", "descricao", "valor")
+SQL_EXPORTAR_TRANSACOES = sql.SQL("""
+    SELECT {colunas}
+    FROM transacoes
+    WHERE data >= {inicio} AND data < {fim}
+    ORDER BY data, id
+""")
+
+def _query_exportacao(inicio, fim):
+    return SQL_EXPORTAR_TRANSACOES.format(
+        colunas=sql.SQL(', ').join(map(sql.Identifier, COLUNAS_EXPORTACAO)),
+        inicio=sql.Literal(inicio), fim=sql.Literal(fim))
+
+async def copiar_transacoes_csv_async(inicio, fim, arquivo):
+    """Grava em `arquivo` o CSV das transações de [inicio, fim) via COPY TO STDOUT; retorna o nº de linhas"""
+    query = sql.SQL("COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER true)").format(_query_exportacao(inicio, fim))
+    rotulo = 'COPY transacoes TO STDOUT'
+    comeco = time.perf_counter()
+    try:
+        async with async_pool.connection() as conn:
+            async with conn.cursor() as cur:
+                async with cur.copy(query) as copy:
+                    async for dados in copy:
+                        arquivo.write(dados)
+                linhas = cur.rowcount
+    except Exception:
+        registrar_erro_query(rotulo)
+        raise
+    registrar_query(rotulo, time.perf_counter() - comeco, linhas)
+    return linhas
+
+def iterar_transacoes_exportacao(inicio, fim, lote=EXPORTACAO_LOTE):
+    """Percorre as transações de [inicio, fim) em lotes com um cursor no servidor (pool síncrono)"""
+    query = _query_exportacao(inicio, fim)
+    rotulo = 'SELECT transacoes exportacao'
+    comeco = time.perf_counter()
+    linhas = 0
+    try:
+        with pool.connection() as conn:
+            with conn.cursor(name='transacoes_exportacao') as cur:
+                cur.execute(query)
+                while rows := cur.fetchmany(lote):
+                    linhas += len(rows)
+                    yield rows
+    except Exception:
+        registrar_erro_query(rotulo)
+        raise
+    registrar_query(rotulo, time.perf_counter() - comeco, linhas)
+
+# Importação: os lançamentos vão por COPY para uma tabela temporária e de lá para
+# transacoes, descontando os que já existem (mesma data, tipo, valor e descrição).
+# Lançamentos idênticos no arquivo contam separadamente: só entra o que exceder
+# o número de cópias já gravadas, então reimportar o mesmo extrato não duplica nada.
+COLUNAS_STAGING_IMPORTACAO = ("linha", "data", "tipo", "categoria", "categoria_principal",
+                              "subcategoria", "valor", "descricao")
+SQL_CRIAR_STAGING_IMPORTACAO = """
+    CREATE TEMP TABLE importacao_staging (
+        linha INTEGER,
+        data DATE,
+        tipo TEXT,
+        categoria TEXT,
+        categoria_principal TEXT,
+        subcategoria TEXT,
+        valor DECIMAL(10, 2),
+        descricao TEXT
+    ) ON COMMIT DROP
+"""
+SQL_INSERIR_STAGING_IMPORTACAO = """
+    WITH staging AS (
+        SELECT *, ROW_NUMBER() OVER (PARTITION BY data, tipo, valor, descricao ORDER BY linha) AS ocorrencia
+        FROM importacao_staging
+    ),
+    existentes AS (
+        SELECT data, tipo, valor, descricao, COUNT(*) AS quantidade
+        FROM transacoes
+        WHERE data BETWEEN (SELECT MIN(data) FROM importacao_staging)
+                       AND (SELECT MAX(data) FROM importacao_staging)
+        GROUP BY 1, 2, 3, 4
+    )
+    INSERT INTO transacoes (user_id, tipo, categoria, categoria_principal, subcategoria, valor, descricao, data)
+    SELECT %s, s.tipo, s.categoria, s.categoria_principal, s.subcategoria, s.valor, s.descricao, s.data
+    FROM staging s
+    LEFT JOIN existentes e USING (data, tipo, valor, descricao)
+    WHERE s.ocorrencia > COALESCE(e.quantidade, 0)
+"""
+
+def importar_lancamentos(lancamentos, user_id):
+    """Carrega os lançamentos (tuplas em COLUNAS_STAGING_IMPORTACAO) numa única transação.
+
+    Retorna (lidos, inseridos).
     """
-    return execute_with_retry(query, (limit,), fetch=True)
+    rotulo = 'COPY importacao_staging FROM STDIN'
+    comeco = time.perf_counter()
+    try:
+        with pool.connection() as conn:
+            with conn.transaction():
+                conn.execute(SQL_CRIAR_STAGING_IMPORTACAO)
+                copy_sql = sql.SQL("COPY importacao_staging ({}) FROM STDIN").format(
+                    sql.SQL(', ').join(map(sql.Identifier, COLUNAS_STAGING_IMPORTACAO)))
+                with conn.cursor() as cur:
+                    with cur.copy(copy_sql) as copy:
+                        for lancamento in lancamentos:
+                            copy.write_row(lancamento)
+                    lidos = cur.rowcount
+                # Tabelas temporárias não passam pelo autovacuum: sem estatísticas o
+                # planejador estima mal o join com transacoes
+                conn.execute("ANALYZE importacao_staging")
+                inseridos = conn.execute(SQL_INSERIR_STAGING_IMPORTACAO, (user_id,)).rowcount
+    except Exception:
+        registrar_erro_query(rotulo)
+        raise
+    registrar_query(rotulo, time.perf_counter() - comeco, lidos)
+    return lidos, inseridos
+
+SQL_TOTAIS_MES = """
+    SELECT COALESCE(SUM(total) FILTER (WHERE tipo = 'receita'), 0),
+           COALESCE(SUM(total) FILTER (WHERE tipo = 'despesa'), 0)
+    FROM resumo_mensal
+    WHERE ano = %s AND mes = %s
+"""
+
+async def get_totais_mes_async(mes, ano):
+    """Retorna (receitas, despesas) do mês como Decimal, sem passar pelo pandas"""
+    result = await execute_with_retry_async(SQL_TOTAIS_MES, (ano, mes), fetch=True)
+    return result[0]
+
+SQL_VERSAO_MES = "SELECT COALESCE((SELECT versao FROM versao_mes WHERE ano = %s AND mes = %s), 0)"
+
+async def get_versao_mes_async(mes, ano):
+    """Versão dos dados do mês (incrementada pelo trigger a cada escrita)"""
+    result = await execute_with_retry_async(SQL_VERSAO_MES, (ano, mes), fetch=True)
+    return result[0][0]
+
+# Tendência: o resumo_mensal já está agrupado por mês, então a janela inteira
+# sai numa única consulta, sem uma ida ao banco por mês
+SQL_VERSOES_PERIODO = """
+    SELECT ano, mes, versao FROM versao_mes
+    WHERE (ano, mes) >= (%s, %s) AND (ano, mes) < (%s, %s)
+    ORDER BY ano, mes
+"""
+SQL_TENDENCIA = """
+    SELECT make_date(ano, mes, 1) AS mes, categoria, tipo, total
+    FROM resumo_mensal
+    WHERE (ano, mes) >= (%s, %s) AND (ano, mes) < (%s, %s)
+"""
+SQL_CATEGORIAS_TENDENCIA = """
+    SELECT categoria FROM resumo_mensal
+    WHERE tipo = 'despesa' AND (ano, mes) >= (%s, %s) AND (ano, mes) < (%s, %s)
+    GROUP BY categoria
+    ORDER BY SUM(total) DESC
+    LIMIT %s
+"""
+
+def _params_periodo(inicio, fim):
+    return (inicio.year, inicio.month, fim.year, fim.month)
+
+async def get_versoes_periodo_async(inicio, fim):
+    """Versões de cada mês em [inicio, fim), como tupla de (ano, mes, versao)"""
+    result = await execute_with_retry_async(SQL_VERSOES_PERIODO, _params_periodo(inicio, fim), fetch=True)
+    return tuple(tuple(linha) for linha in result)
+
+async def get_categorias_tendencia_async(inicio, fim, limite=8):
+    """Categorias de despesa com maior gasto no período"""
+    result = await execute_with_retry_async(
+        SQL_CATEGORIAS_TENDENCIA, _params_periodo(inicio, fim) + (limite,), fetch=True)
+    return [linha[0] for linha in result]
+
+async def gerar_tendencia_async(inicio, fim, categoria=None):
+    """Totais por mês, categoria e tipo em [inicio, fim), opcionalmente de uma só categoria"""
+    await carregar_analise_async()
+    query, params = SQL_TENDENCIA, _params_periodo(inicio, fim)
+    if categoria:
+        query, params = query + " AND categoria = %s", params + (categoria,)
+    try:
+        return await fetch_dataframe_async(query, params)
+    except Exception as e:
+        logging.error(f"Erro ao gerar tendência: {e}")
+        return pd.DataFrame()
+
+SQL_ULTIMOS_LANCAMENTOS = """
+    SELECT id, data, tipo, categoria, descricao, valor, user_id 
+    FROM transacoes 
+    ORDER BY id DESC LIMIT %s
+"""
+
+async def get_ultimos_lancamentos_async(limit=7):
+    return await execute_with_retry_async(SQL_ULTIMOS_LANCAMENTOS, (limit,), fetch=True)
 
-def get_transacao(tx_id):
-    query = "SELECT * FROM transacoes WHERE id = %s"
-    result = execute_with_retry(query, (tx_id,), fetch=True)
+SQL_TRANSACAO = f"SELECT {COLUNAS_TRANSACAO} FROM transacoes WHERE id = %s"
+
+async def get_transacao_async(tx_id):
+    result = await execute_with_retry_async(SQL_TRANSACAO, (tx_id,), fetch=True)
     return result[0] if result else None
 
-def update_transacao_campo(tx_id, campo, novo_valor):
+def _query_update_transacao(tx_id, campo, novo_valor):
+    if campo == 'categoria':
+        principal, subcategoria = separar_categoria(novo_valor)
+        query = f"UPDATE transacoes SET categoria = %s, categoria_principal = %s, subcategoria = %s WHERE id = %s RETURNING {COLUNAS_TRANSACAO}"
+        return query, (novo_valor, principal, subcategoria, tx_id)
+
+    valor_ajustado = float(novo_valor) if campo == 'valor' else novo_valor
+    
+    query = f"UPDATE transacoes SET {campo} = %s WHERE id = %s RETURNING {COLUNAS_TRANSACAO}"
+    return query, (valor_ajustado, tx_id)
+
+async def update_transacao_campo_async(tx_id, campo, novo_valor):
+    """Atualiza um campo e retorna a linha atualizada (None se falhar)"""
     try:
         if campo not in ['valor', 'categoria', 'descricao']:
-            return False
-            
-        valor_ajustado = float(novo_valor) if campo == 'valor' else novo_valor
-        
-        query = f"UPDATE transacoes SET {campo} = %s WHERE id = %s"
-        params = (valor_ajustado, tx_id)
+            return None
+
+        query, params = _query_update_transacao(tx_id, campo, novo_valor)
 
-        result = execute_with_retry(query, params)
-        return result > 0
+        return await execute_with_retry_async(query, params)
     except Exception as e:
         logging.error(f"Erro ao atualizar transação {tx_id} no campo {campo}: {e}")
-        return False
+        return None
         
-def update_transacao_valor(tx_id, novo_valor):
-    return update_transacao_campo(tx_id, 'valor', novo_valor)
+async def update_transacao_valor_async(tx_id, novo_valor):
+    return await update_transacao_campo_async(tx_id, 'valor', novo_valor)
 
-def add_user(user_id, first_name):
-    query = """
-        INSERT INTO users (telegram_id, first_name) 
-        VALUES (%s, %s) 
-        ON CONFLICT (telegram_id) DO NOTHING
-    """
-    execute_with_retry(query, (user_id, first_name))
+SQL_ADD_USER = """
+    INSERT INTO users (telegram_id, first_name) 
+    VALUES (%s, %s) 
+    ON CONFLICT (telegram_id) DO NOTHING
+"""
+
+async def add_user_async(user_id, first_name):
+    await execute_with_retry_async(SQL_ADD_USER, (user_id, first_name))
 
 meses = {
     'January': 'Janeiro',
@@ -384,18 +1512,27 @@ meses = {
 }
 
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "256"))
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "16"))
 AUTHORIZED_USERS = [id.strip() for id in os.getenv("AUTHORIZED_USERS", "").split(',')]
 
+# Modo de recebimento das atualizações: 'polling' (padrão) ou 'webhook', em que o
+# Telegram envia cada update por POST para WEBHOOK_URL + WEBHOOK_PATH nesta mesma porta
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip('/')
+WEBHOOK_PATH = '/' + os.getenv("WEBHOOK_PATH", "telegram").strip('/')
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+if BOT_MODE not in ('polling', 'webhook'):
+    logging.warning(f"BOT_MODE '{BOT_MODE}' desconhecido; usando 'polling'")
+    BOT_MODE = 'polling'
+
 BRAZIL_TZ = pytz.timezone('America/Sao_Paulo')
 
 def get_brazil_now():
     return datetime.now(BRAZIL_TZ)
 
-app = Flask(__name__)
-
-@app.route('/')
-def home():
-    return render_template_string('''
+async def home(request):
+    return HTMLResponse('''
     <!DOCTYPE html>
     <html>
     <head>
@@ -470,27 +1607,105 @@ def home():
     </html>
     ''')
 
-@app.route('/status')
-def status():
-    return jsonify({
+async def status(request):
+    return JSONResponse({
         'status': 'online',
         'bot': 'financial_assistant',
         'timestamp': datetime.now().isoformat(),
         'version': '14.0' # Versão atualizada para refletir a nova funcionalidade
     })
 
-@app.route('/health')
-def health():
+async def metrics(request):
+    return PlainTextResponse(gerar_metricas_prometheus(), media_type='text/plain; version=0.0.4')
+
+# --- MONITOR DE SAÚDE ---
+# As sondas rodam em segundo plano; o /health só lê o último resultado, então
+# sondas frequentes da plataforma não disputam conexões com o bot
+HEALTH_INTERVAL = float(os.getenv("HEALTH_INTERVAL", "15"))
+HEALTH_TIMEOUT = float(os.getenv("HEALTH_TIMEOUT", "5"))
+HEALTH_STALE_FACTOR = 3  # resultado mais velho que 3 intervalos é obsoleto
+
+_saude = {'database': None, 'bot': None, 'latencia': None, 'verificado_em': None,
+          'verificado_mono': None, 'erro': None}
+
+async def _sondar_banco():
+    async with async_pool.connection() as conn:
+        await conn.execute("SELECT 1")
+
+async def verificar_saude(application):
+    """Executa as sondas do banco e do bot e atualiza o snapshot"""
+    inicio = time.perf_counter()
     try:
-        execute_with_retry("SELECT 1", fetch=True)
-        db_status = "healthy"
-    except:
-        db_status = "error"
-    
-    return jsonify({
-        'status': 'healthy',
-        'database': db_status
-    })
+        await asyncio.wait_for(_sondar_banco(), HEALTH_TIMEOUT)
+        database, erro = 'healthy', None
+    except Exception as e:
+        database, erro = 'error', f"{type(e).__name__}: {e}"
+    latencia = time.perf_counter() - inicio
+    rodando = application.running and (application.updater is None or application.updater.running)
+    _saude.update(database=database, bot='running' if rodando else 'stopped', latencia=latencia,
+                  verificado_em=datetime.now(), verificado_mono=time.monotonic(), erro=erro)
+    if erro:
+        logging.warning(f"Sonda de saúde do banco falhou em {latencia * 1000:.0f} ms: {erro}")
+
+async def monitorar_saude(application):
+    """Repete as sondas a cada HEALTH_INTERVAL segundos"""
+    while True:
+        await asyncio.sleep(HEALTH_INTERVAL)
+        try:
+            await verificar_saude(application)
+        except Exception as e:
+            logging.error(f"Erro no monitor de saúde: {e}")
+
+def snapshot_saude():
+    """Último resultado das sondas, com a idade e se está obsoleto"""
+    idade = time.monotonic() - _saude['verificado_mono'] if _saude['verificado_mono'] else None
+    obsoleto = idade is None or idade > HEALTH_INTERVAL * HEALTH_STALE_FACTOR
+    saudavel = _saude['database'] == 'healthy' and _saude['bot'] == 'running' and not obsoleto
+    return {
+        'status': 'healthy' if saudavel else ('starting' if _saude['verificado_em'] is None else 'unhealthy'),
+        'database': _saude['database'],
+        'bot': _saude['bot'],
+        'probe_latency_ms': round(_saude['latencia'] * 1000, 1) if _saude['latencia'] is not None else None,
+        'checked_at': _saude['verificado_em'].isoformat() if _saude['verificado_em'] else None,
+        'age_seconds': round(idade, 1) if idade is not None else None,
+        'stale': obsoleto,
+        'error': _saude['erro'],
+    }
+
+async def health(request):
+    snapshot = snapshot_saude()
+    return JSONResponse(snapshot, status_code=200 if snapshot['status'] == 'healthy' else 503)
+
+# Preenchido por run_servicos quando o bot está pronto para receber updates
+_bot_application = None
+
+async def telegram_webhook(request):
+    if BOT_MODE != 'webhook':
+        return Response(status_code=404)
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+        logging.warning(f"Webhook recusado: secret token inválido ({request.client.host if request.client else '?'})")
+        return Response(status_code=403)
+    if _bot_application is None:
+        # Ainda inicializando: o Telegram reenvia o update mais tarde
+        return Response(status_code=503)
+    try:
+        dados = await request.json()
+    except ValueError:
+        return Response(status_code=400)
+    if not isinstance(dados, dict):
+        return Response(status_code=400)
+    # Servidor e bot dividem o mesmo loop: o update vai direto para a fila do Application
+    await _bot_application.update_queue.put(Update.de_json(dados, _bot_application.bot))
+    return Response(status_code=200)
+
+app = Starlette(routes=[
+    Route('/', home),
+    Route('/status', status),
+    Route('/metrics', metrics),
+    Route('/health', health),
+    Route(WEBHOOK_PATH, telegram_webhook, methods=['POST']),
+])
 
 def format_brl(value):
     if not isinstance(value, (int, float, Decimal)):
@@ -526,95 +1741,459 @@ def get_alerta_divertido(categoria, percentual_usado):
     nivel = next((n for n in [100, 80, 50] if percentual_usado >= n), 0)
     return random.choice(alertas[nivel]) if nivel else None
 
-def criar_relatorio_visual(df, mes, ano):
+# Perfis de saída das imagens. O DPI sai da largura alvo (lado maior da imagem em
+# pixels) dividida pelo tamanho da figura, limitado a [dpi_min, dpi]: o Telegram
+# reduz fotos para 1280 px no lado maior, então gerar mais que isso só aumenta o
+# upload. O 'mobile' busca o menor arquivo legível no celular com paleta reduzida
+# (gráficos têm poucas cores chapadas); o 'jpeg' troca a paleta por compressão com
+# perdas; o 'print' mantém 300 dpi em cores completas.
+PERFIS_RELATORIO = {
+    'mobile': {'largura': 1280, 'dpi_min': 72, 'dpi': 150, 'formato': 'png', 'cores': 64},
+    'jpeg': {'largura': 1280, 'dpi_min': 72, 'dpi': 150, 'formato': 'jpeg', 'qualidade': 80, 'cores': None},
+    'print': {'largura': None, 'dpi_min': 300, 'dpi': 300, 'formato': 'png', 'cores': None},
+}
+REPORT_PROFILE = os.getenv("REPORT_PROFILE", "mobile")
+if REPORT_PROFILE not in PERFIS_RELATORIO:
+    logging.warning(f"REPORT_PROFILE '{REPORT_PROFILE}' desconhecido; usando 'mobile'")
+    REPORT_PROFILE = 'mobile'
+
+def _dpi_perfil(fig, config):
+    """DPI que leva o lado maior da figura à largura alvo do perfil"""
+    if not config['largura']:
+        return config['dpi']
+    return min(config['dpi'], max(config['dpi_min'], config['largura'] / max(fig.get_size_inches())))
+
+def salvar_figura(fig, perfil):
+    """Exporta a figura conforme o perfil; devolve (bytes, info com formato, DPI e dimensões)"""
+    config = PERFIS_RELATORIO[perfil]
+    dpi = _dpi_perfil(fig, config)
+    buffer = BytesIO()
+    fig.savefig(buffer, format='png', dpi=dpi)
+    buffer.seek(0)
+    imagem = Image.open(buffer)  # só lê o cabeçalho até ser necessário
+    largura, altura = imagem.size
+
+    if config['formato'] != 'png' or config['cores']:
+        imagem = imagem.convert('RGB')
+        if config['cores']:
+            imagem = imagem.quantize(colors=config['cores'], method=Image.Quantize.FASTOCTREE,
+                                     dither=Image.Dither.NONE)
+        buffer = BytesIO()
+        if config['formato'] == 'png':
+            imagem.save(buffer, format='PNG', optimize=True)
+        else:
+            # JPEG/WebP não aceitam imagem com paleta
+            imagem.convert('RGB').save(buffer, format=config['formato'].upper(),
+                                       quality=config['qualidade'], optimize=True)
+
+    info = {'perfil': perfil, 'formato': config['formato'], 'dpi': round(dpi), 'largura': largura,
+            'altura': altura, 'bytes': buffer.getbuffer().nbytes}
+    return buffer.getvalue(), info
+
+# As funções de gráfico rodam no pool de processos de renderização (ver renderizar_relatorio):
+# usam a API orientada a objetos (Figure/Agg), sem o estado global do pyplot, e devolvem
+# a imagem já no formato do perfil escolhido junto com suas dimensões (ver salvar_figura).
+def criar_relatorio_visual(df, mes, ano, perfil=REPORT_PROFILE):
     if df.empty:
         return None
+    carregar_analise()
     
     receitas = df[df['tipo'] == 'receita']['total'].sum()
     despesas = df[df['tipo'] == 'despesa']['total'].sum()
     saldo = receitas - despesas
     nome_mes_ano = f"{meses[calendar.month_name[mes]].capitalize()}/{ano}"
 
-    plt.style.use('seaborn-v0_8-whitegrid')
-    fig, axes = plt.subplots(2, 2, figsize=(16, 12))
-    fig.suptitle(f'Relatório Financeiro - {nome_mes_ano}', fontsize=20, weight='bold')
+    with mpl_style.context('seaborn-v0_8-whitegrid'):
+        fig = Figure(figsize=(16, 12))
+        axes = fig.subplots(2, 2)
+        fig.suptitle(f'Relatório Financeiro - {nome_mes_ano}', fontsize=20, weight='bold')
+
+        despesas_cat = df[df['tipo'] == 'despesa']
+        if not despesas_cat.empty:
+            axes[0, 0].pie(despesas_cat['total'], labels=despesas_cat['categoria'], 
+                            autopct='%1.1f%%', startangle=140, 
+                            colors=sns.color_palette("Reds_r", len(despesas_cat)))
+            axes[0, 0].set_title('Composição das Despesas', fontsize=14)
+        else:
+            axes[0, 0].text(0.5, 0.5, 'Sem despesas', ha='center', va='center', fontsize=14)
+            axes[0, 0].set_title('Composição das Despesas', fontsize=14)
+
+        receitas_cat = df[df['tipo'] == 'receita']
+        if not receitas_cat.empty:
+            axes[0, 1].pie(receitas_cat['total'], labels=receitas_cat['categoria'], 
+                            autopct='%1.1f%%', startangle=140, 
+                            colors=sns.color_palette("Greens_r", len(receitas_cat)))
+            axes[0, 1].set_title('Composição das Receitas', fontsize=14)
+        else:
+            axes[0, 1].text(0.5, 0.5, 'Sem receitas', ha='center', va='center', fontsize=14)
+            axes[0, 1].set_title('Composição das Receitas', fontsize=14)
+
+        cores = ['green', 'red', 'blue' if saldo >= 0 else 'orange']
+        sns.barplot(x=['Receitas', 'Despesas', 'Saldo'], y=[receitas, despesas, saldo], 
+                    ax=axes[1, 0], palette=cores)
+        axes[1, 0].set_title('Resumo Financeiro do Mês', fontsize=14)
+        axes[1, 0].set_ylabel('Valor (R$)')
+        
+        for p in axes[1, 0].patches:
+            axes[1, 0].annotate(format_brl(p.get_height()),
+                                (p.get_x() + p.get_width() / 2., p.get_height()),
+                                ha='center', va='center', xytext=(0, 9),
+                                textcoords='offset points')
+
+        top_despesas = despesas_cat.sort_values('total', ascending=False).head(5)
+        if not top_despesas.empty:
+            sns.barplot(x='total', y='categoria', data=top_despesas, 
+                        ax=axes[1, 1], palette='Reds_r', orient='h')
+            axes[1, 1].set_title('Top 5 Despesas', fontsize=14)
+            axes[1, 1].set_xlabel('Valor (R$)')
+            axes[1, 1].set_ylabel('')
+        else:
+            axes[1, 1].axis('off')
+            axes[1, 1].text(0.5, 0.5, 'Sem despesas\npara o ranking', 
+                             ha='center', va='center', fontsize=12)
+
+        fig.tight_layout(rect=[0, 0, 1, 0.96])
+        return salvar_figura(fig, perfil)
+
+# Relatório detalhado: lido do cursor no servidor em lotes e gravado num arquivo
+# temporário que fica em memória até DETALHADO_SPOOL_BYTES e depois vai para o disco
+DETALHADO_SPOOL_BYTES = 1024 * 1024
+_TRADUCAO_BRL = str.maketrans(',.', '.,')  # 1,234.56 -> 1.234,56
+_SEPARADOR_DETALHADO = '-' * 30
+
+def _linhas_relatorio_detalhado(rows):
+    """Formata um lote de transações no layout do relatório detalhado"""
+    for data, tipo, categoria, descricao, valor in rows:
+        sinal = '+' if tipo == 'receita' else '-'
+        valor_fmt = f"{valor or 0:,.2f}".translate(_TRADUCAO_BRL)
+        yield (f"Data: {data:%d/%m/%Y}\nTipo: {(tipo or '').capitalize()}\nCategoria: {categoria}\n"
+               f"Descrição: {descricao}\nValor: {sinal}{valor_fmt}\n{_SEPARADOR_DETALHADO}\n")
+
+async def gerar_relatorio_detalhado_async(mes, ano):
+    """Gera o relatório detalhado (categorias completas, inclui subcategorias) em um arquivo temporário.
+
+    Retorna o arquivo binário posicionado no início, ou None se o mês não tem transações.
+    """
+    inicio = time.perf_counter()
+    nome_mes_ano = f"{meses[calendar.month_name[mes]].capitalize()}/{ano}"
+    arquivo = tempfile.SpooledTemporaryFile(max_size=DETALHADO_SPOOL_BYTES)
+    arquivo.write(f"Relatório Detalhado - {nome_mes_ano}\n{'='*50}\n\n".encode('utf-8'))
+    vazio = True
+    try:
+        async for rows in iterar_transacoes_mes_async(mes, ano):
+            vazio = False
+            arquivo.write(''.join(_linhas_relatorio_detalhado(rows)).encode('utf-8'))
+    except Exception as e:
+        logging.error(f"Erro ao gerar relatório: {e}")
+        arquivo.close()
+        return None
 
-    despesas_cat = df[df['tipo'] == 'despesa']
-    if not despesas_cat.empty:
-        axes[0, 0].pie(despesas_cat['total'], labels=despesas_cat['categoria'], 
-                        autopct='%1.1f%%', startangle=140, 
-                        colors=sns.color_palette("Reds_r", len(despesas_cat)))
-        axes[0, 0].set_title('Composição das Despesas', fontsize=14)
-    else:
-        axes[0, 0].text(0.5, 0.5, 'Sem despesas', ha='center', va='center', fontsize=14)
-        axes[0, 0].set_title('Composição das Despesas', fontsize=14)
-
-    receitas_cat = df[df['tipo'] == 'receita']
-    if not receitas_cat.empty:
-        axes[0, 1].pie(receitas_cat['total'], labels=receitas_cat['categoria'], 
-                        autopct='%1.1f%%', startangle=140, 
-                        colors=sns.color_palette("Greens_r", len(receitas_cat)))
-        axes[0, 1].set_title('Composição das Receitas', fontsize=14)
-    else:
-        axes[0, 1].text(0.5, 0.5, 'Sem receitas', ha='center', va='center', fontsize=14)
-        axes[0, 1].set_title('Composição das Receitas', fontsize=14)
-
-    cores = ['green', 'red', 'blue' if saldo >= 0 else 'orange']
-    sns.barplot(x=['Receitas', 'Despesas', 'Saldo'], y=[receitas, despesas, saldo], 
-                ax=axes[1, 0], palette=cores)
-    axes[1, 0].set_title('Resumo Financeiro do Mês', fontsize=14)
-    axes[1, 0].set_ylabel('Valor (R$)')
-    
-    for p in axes[1, 0].patches:
-        axes[1, 0].annotate(format_brl(p.get_height()),
-                            (p.get_x() + p.get_width() / 2., p.get_height()),
-                            ha='center', va='center', xytext=(0, 9),
-                            textcoords='offset points')
-
-    top_despesas = despesas_cat.sort_values('total', ascending=False).head(5)
-    if not top_despesas.empty:
-        sns.barplot(x='total', y='categoria', data=top_despesas, 
-                    ax=axes[1, 1], palette='Reds_r', orient='h')
-        axes[1, 1].set_title('Top 5 Despesas', fontsize=14)
-        axes[1, 1].set_xlabel('Valor (R$)')
-        axes[1, 1].set_ylabel('')
-    else:
-        axes[1, 1].axis('off')
-        axes[1, 1].text(0.5, 0.5, 'Sem despesas\npara o ranking', 
-                         ha='center', va='center', fontsize=12)
+    if vazio:
+        arquivo.close()
+        return None
+    registrar_relatorio('detalhado', time.perf_counter() - inicio, arquivo.tell())
+    arquivo.seek(0)
+    return arquivo
+
+# --- EXPORTAÇÃO (CSV/XLSX) ---
+FORMATOS_EXPORTACAO = ('csv', 'xlsx')
+LIMITE_UPLOAD_BYTES = 50 * 1024 * 1024  # limite de documentos da Bot API
+
+def _interpretar_data_exportacao(texto):
+    """Converte dd/mm/aaaa, mm/aaaa ou aaaa no intervalo [inicio, fim) correspondente"""
+    partes = texto.split('/')
+    if len(partes) == 3:
+        inicio = datetime.strptime(texto, '%d/%m/%Y').date()
+        return inicio, inicio + relativedelta(days=1)
+    if len(partes) == 2:
+        inicio = datetime.strptime(texto, '%m/%Y').date()
+        return inicio, inicio + relativedelta(months=1)
+    inicio = datetime.strptime(texto, '%Y').date()
+    return inicio, inicio + relativedelta(years=1)
+
+def parse_periodo_exportacao(args):
+    """Interpreta os argumentos de /exportar: [csv|xlsx] [início] [fim].
+
+    Sem datas exporta o mês atual. Retorna (formato, inicio, fim) com fim exclusivo;
+    levanta ValueError para argumentos inválidos.
+    """
+    args = list(args)
+    formato = 'csv'
+    if args and args[0].lower() in FORMATOS_EXPORTACAO:
+        formato = args.pop(0).lower()
+    if len(args) > 2:
+        raise ValueError("argumentos demais")
+    if not args:
+        hoje = get_brazil_now()
+        inicio, fim = get_intervalo_mes(hoje.month, hoje.year)
+        return formato, inicio, fim
+
+    inicio, fim = _interpretar_data_exportacao(args[0])
+    if len(args) == 2:
+        fim = _interpretar_data_exportacao(args[1])[1]
+    if fim <= inicio:
+        raise ValueError("período vazio")
+    return formato, inicio, fim
+
+def gravar_transacoes_xlsx(inicio, fim, arquivo):
+    """Grava a planilha das transações de [inicio, fim) linha a linha; retorna o nº de linhas"""
+    import xlsxwriter
+
+    # constant_memory descarrega cada linha em disco assim que a próxima começa
+    workbook = xlsxwriter.Workbook(arquivo, {'constant_memory': True})
+    planilha = workbook.add_worksheet('Transações')
+    formato_data = workbook.add_format({'num_format': 'dd/mm/yyyy'})
+    formato_valor = workbook.add_format({'num_format': '#,##0.00'})
+    cabecalho = workbook.add_format({'bold': True})
+
+    for coluna, largura in enumerate((8, 12, 10, 30, 20, 22, 40, 14)):
+        planilha.set_column(coluna, coluna, largura)
+    planilha.write_row(0, 0, COLUNAS_EXPORTACAO, cabecalho)
+
+    linha = 0
+    for rows in iterar_transacoes_exportacao(inicio, fim):
+        for tx_id, data, tipo, categoria, principal, subcategoria, descricao, valor in rows:
+            linha += 1
+            planilha.write_number(linha, 0, tx_id)
+            if data is not None:
+                planilha.write_datetime(linha, 1, data, formato_data)
+            planilha.write_row(linha, 2, (tipo, categoria, principal, subcategoria, descricao))
+            if valor is not None:
+                planilha.write_number(linha, 7, float(valor), formato_valor)
+    workbook.close()
+    return linha
+
+async def exportar_transacoes(formato, inicio, fim):
+    """Gera a exportação em um arquivo temporário; retorna (arquivo, linhas) com o arquivo no início"""
+    comeco = time.perf_counter()
+    arquivo = tempfile.SpooledTemporaryFile(max_size=EXPORTACAO_SPOOL_BYTES)
+    try:
+        if formato == 'csv':
+            arquivo.write('\ufeff'.encode('utf-8'))  # BOM para o Excel reconhecer UTF-8
+            linhas = await copiar_transacoes_csv_async(inicio, fim, arquivo)
+        else:
+            # xlsxwriter é síncrono: roda numa thread com o pool síncrono
+            linhas = await asyncio.to_thread(gravar_transacoes_xlsx, inicio, fim, arquivo)
+    except BaseException:
+        arquivo.close()
+        raise
+    arquivo.seek(0, os.SEEK_END)
+    registrar_relatorio(f'exportar_{formato}', time.perf_counter() - comeco, arquivo.tell())
+    arquivo.seek(0)
+    return arquivo, linhas
+
+# --- IMPORTAÇÃO DE EXTRATOS (CSV/OFX) ---
+LIMITE_DOWNLOAD_BYTES = 20 * 1024 * 1024  # limite de download de arquivos da Bot API
+IMPORTACAO_SPOOL_BYTES = 1024 * 1024  # extratos maiores que isso são baixados para o disco
+MAX_REJEITADAS_EXIBIDAS = 5
+
+# Regras de categoria aplicadas à descrição (sem acentos, minúscula):
+# (padrão, categoria sem cartão, subcategoria quando o extrato é de um cartão)
+REGRAS_CATEGORIA_IMPORTACAO = [
+    (r'supermerc|mercado|atacad|assai|carrefour|pao de acucar|hortifruti', 'Mercado', 'MERCADO 🛒'),
+    (r'posto|combust|gasolina|shell|ipiranga|petrobras', 'Transporte', 'GASOLINA 🚗'),
+    (r'uber|99 ?(app|pop|taxi)|cabify', 'Transporte', 'UBER 🚘'),
+    (r'metro|onibus|brt|passage|bilhete|latam|gol linhas|azul linhas', 'Transporte', 'PASSAGEM 🚍'),
+    (r'ifood|rappi|lanch|burger|mc ?donald|padaria|restaurante|pizza', 'Lazer', 'LANCHES 🍟'),
+    (r'netflix|spotify|disney|prime video|hbo|globoplay|youtube|deezer', 'Lazer', 'STREAMING 📺'),
+    (r'\b(claro|vivo|tim|oi)\b', 'Diversos', 'PLANO CELULARES 📱'),
+    (r'cinema|ingresso|show|teatro|\bbar\b', 'Lazer', 'LAZER 🎉'),
+    (r'farmacia|drogaria|droga ?raia|hospital|clinica|laboratorio', 'Saúde', None),
+    (r'aluguel', 'Aluguel', None),
+    (r'condominio|energia|\bluz\b|saneamento|internet', 'Apto', None),
+    (r'escola|faculdade|curso|livraria', 'Educação', None),
+]
+REGRAS_RECEITA_IMPORTACAO = [
+    (r'salario|folha|proventos', 'Salário'),
+    (r'rendimento|dividendo|juros|resgate', 'Investimentos'),
+]
+_REGRAS_DESPESA = [(re.compile(padrao), categoria, sub) for padrao, categoria, sub in REGRAS_CATEGORIA_IMPORTACAO]
+_REGRAS_RECEITA = [(re.compile(padrao), categoria) for padrao, categoria in REGRAS_RECEITA_IMPORTACAO]
+
+# Nomes de coluna aceitos nos CSV (normalizados)
+COLUNAS_CSV_IMPORTACAO = {
+    'data': ('data', 'date', 'data lancamento', 'data da compra', 'data de lancamento'),
+    'descricao': ('descricao', 'historico', 'lancamento', 'title', 'description', 'memo', 'estabelecimento'),
+    'valor': ('valor', 'amount', 'value', 'valor (r$)', 'valor r$'),
+    'tipo': ('tipo',),
+    'categoria': ('categoria',),
+}
+FORMATOS_DATA_IMPORTACAO = ('%d/%m/%Y', '%Y-%m-%d', '%d/%m/%y', '%d-%m-%Y')
+_RE_TAG_OFX = re.compile(r'<(/?)([A-Za-z0-9.]+)>([^<\r\n]*)')
+
+def _normalizar_texto(texto):
+    """Minúsculas e sem acentos, para comparar nomes e aplicar as regras"""
+    decomposto = unicodedata.normalize('NFKD', texto or '')
+    return ''.join(c for c in decomposto if not unicodedata.combining(c)).lower().strip()
+
+def resolver_cartao(texto):
+    """Encontra o cartão em CARTOES_ESPECIAIS pelo nome completo ou só pelo banco ('nubank')"""
+    alvo = _normalizar_texto(texto)
+    for cartao in CARTOES_ESPECIAIS:
+        nome = _normalizar_texto(cartao)
+        if alvo in (nome, nome.removeprefix('cartao ')):
+            return cartao
+    return None
+
+def _parse_valor_importacao(texto):
+    """Aceita 1.234,56 / 1234.56 / -R$ 10,00 / (10,00); retorna Decimal com sinal"""
+    texto = (texto or '').strip().replace('R$', '').replace(' ', '')
+    negativo = texto.startswith('-') or (texto.startswith('(') and texto.endswith(')'))
+    texto = texto.strip('-+()')
+    if ',' in texto and '.' in texto:
+        # O separador que aparece por último é o decimal
+        if texto.rfind(',') > texto.rfind('.'):
+            texto = texto.replace('.', '').replace(',', '.')
+        else:
+            texto = texto.replace(',', '')
+    elif ',' in texto:
+        texto = texto.replace(',', '.')
+    valor = Decimal(texto)
+    return -valor if negativo else valor
+
+def _parse_data_importacao(texto):
+    texto = (texto or '').strip()
+    for formato in FORMATOS_DATA_IMPORTACAO:
+        try:
+            return datetime.strptime(texto, formato).date()
+        except ValueError:
+            continue
+    raise ValueError(f"data inválida '{texto}'")
 
-    plt.tight_layout(rect=[0, 0, 1, 0.96])
-    buffer = BytesIO()
-    plt.savefig(buffer, format='png', dpi=300)
-    buffer.seek(0)
-    plt.close()
-    
-    return buffer
+def _abrir_texto_extrato(arquivo):
+    """Abre o arquivo binário como texto, detectando UTF-8 ou Windows-1252 pelo início"""
+    amostra = arquivo.read(64 * 1024)
+    arquivo.seek(0)
+    try:
+        amostra.decode('utf-8')
+        codificacao = 'utf-8-sig'
+    except UnicodeDecodeError as e:
+        # Um caractere cortado no fim da amostra não conta como erro
+        codificacao = 'utf-8-sig' if e.start >= len(amostra) - 3 else 'cp1252'
+    return io.TextIOWrapper(arquivo, encoding=codificacao, errors='replace', newline='')
+
+def ler_csv_extrato(texto):
+    """Gera um dict por linha do CSV com as colunas reconhecidas (e o nº da linha)"""
+    primeira = texto.readline()
+    delimitador = max(',;\t', key=primeira.count)
+    cabecalho = next(csv.reader([primeira], delimiter=delimitador), [])
+    indices = {}
+    for posicao, nome in enumerate(cabecalho):
+        nome = _normalizar_texto(nome)
+        for campo, aceitos in COLUNAS_CSV_IMPORTACAO.items():
+            if campo not in indices and nome in aceitos:
+                indices[campo] = posicao
+    if 'data' not in indices or 'valor' not in indices:
+        raise ValueError("Cabeçalho do CSV não reconhecido: são necessárias as colunas de data e valor.")
+
+    for numero, campos in enumerate(csv.reader(texto, delimiter=delimitador), start=2):
+        if not any(campo.strip() for campo in campos):
+            continue
+        bruto = {'linha': numero}
+        for campo, posicao in indices.items():
+            bruto[campo] = campos[posicao].strip() if posicao < len(campos) else ''
+        yield bruto
+
+def ler_ofx_extrato(texto):
+    """Gera um dict por <STMTTRN> do OFX (SGML ou XML), lendo linha a linha"""
+    atual = None
+    numero = 0
+    for linha in texto:
+        for fechamento, tag, valor in _RE_TAG_OFX.findall(linha):
+            tag = tag.upper()
+            if tag == 'STMTTRN':
+                if atual is not None:
+                    yield atual
+                atual = None
+                if not fechamento:
+                    numero += 1
+                    atual = {'linha': numero}
+            elif atual is not None and not fechamento:
+                atual[tag] = valor.strip()
+    if atual is not None:
+        yield atual
+
+def _bruto_ofx_para_csv(bruto):
+    return {
+        'linha': bruto['linha'],
+        'data': bruto.get('DTPOSTED', '')[:8],
+        'valor': bruto.get('TRNAMT', ''),
+        'descricao': bruto.get('MEMO') or bruto.get('NAME', ''),
+    }
 
-def criar_relatorio_detalhado(df, mes, ano):
-    if df.empty:
-        return None
-    
-    # O DF aqui JÁ VEM com as categorias completas (Cartão X - Sub)
-    df_sorted = df.sort_values(by='tipo', ascending=False)
-    nome_mes_ano = f"{meses[calendar.month_name[mes]].capitalize()}/{ano}"
-    buffer = StringIO()
-    buffer.write(f"Relatório Detalhado - {nome_mes_ano}\n{'='*50}\n\n")
-    
-    for _, row in df_sorted.iterrows():
-        sinal = '+' if row['tipo'] == 'receita' else '-'
-        buffer.write(
-            f"Data: {format_date_br(str(row['data']))}\nTipo: {row['tipo'].capitalize()}\nCategoria: {row['categoria']}\n"
-        )
-        buffer.write(
-            f"Descrição: {row['descricao']}\nValor: {sinal}{format_brl(row['valor']).replace('R$ ', '')}\n{'-'*30}\n"
-        )
-    
-    buffer.seek(0)
-    return buffer
+def categorizar_lancamento(descricao, tipo, cartao=None):
+    """Aplica as regras de categoria; com cartão, as despesas viram "Cartão X - SUB" """
+    texto = _normalizar_texto(descricao)
+    if tipo == 'receita':
+        return next((categoria for regra, categoria in _REGRAS_RECEITA if regra.search(texto)), 'Diversos')
+    for regra, categoria, subcategoria in _REGRAS_DESPESA:
+        if regra.search(texto):
+            if cartao:
+                return f"{cartao} - {subcategoria}" if subcategoria else cartao
+            return categoria
+    return cartao or 'Diversos'
+
+def _normalizar_lancamento(bruto, cartao, ofx):
+    """Converte uma linha lida do extrato na tupla da staging; levanta ValueError se inválida"""
+    data = (datetime.strptime(bruto['data'], '%Y%m%d').date() if ofx
+            else _parse_data_importacao(bruto.get('data')))
+    try:
+        valor = _parse_valor_importacao(bruto.get('valor'))
+    except InvalidOperation:
+        raise ValueError(f"valor inválido '{bruto.get('valor')}'")
+    descricao = (bruto.get('descricao') or '').strip() or 'Importado'
+
+    tipo = _normalizar_texto(bruto.get('tipo'))
+    if tipo not in ('receita', 'despesa'):
+        # Extrato de conta: saída é negativa. Fatura de cartão em CSV lista as
+        # compras positivas; no OFX elas continuam negativas
+        despesa = valor > 0 if (cartao and not ofx) else valor < 0
+        if cartao and not despesa:
+            raise ValueError("pagamento/estorno de fatura ignorado")
+        tipo = 'despesa' if despesa else 'receita'
+    valor = abs(valor).quantize(Decimal('0.01'))
+    if valor == 0 or valor >= Decimal('100000000'):
+        raise ValueError(f"valor fora do intervalo '{bruto.get('valor')}'")
+
+    categoria = bruto.get('categoria') or categorizar_lancamento(descricao, tipo, cartao)
+    principal, subcategoria = separar_categoria(categoria)
+    return (bruto['linha'], data, tipo, categoria, principal, subcategoria, valor, descricao)
+
+def importar_extrato(arquivo, nome_arquivo, user_id, cartao=None):
+    """Lê o extrato (CSV ou OFX) em fluxo, categoriza e importa numa transação.
+
+    Retorna um dict com lidos, inseridos, duplicados, rejeitadas [(linha, motivo)] e segundos.
+    Levanta ValueError se o arquivo não puder ser interpretado.
+    """
+    comeco = time.perf_counter()
+    ofx = nome_arquivo.lower().endswith(('.ofx', '.qfx'))
+    texto = _abrir_texto_extrato(arquivo)
+    rejeitadas = []
+
+    def lancamentos():
+        brutos = ler_ofx_extrato(texto) if ofx else ler_csv_extrato(texto)
+        for bruto in brutos:
+            if ofx:
+                bruto = _bruto_ofx_para_csv(bruto)
+            try:
+                yield _normalizar_lancamento(bruto, cartao, ofx)
+            except ValueError as e:
+                rejeitadas.append((bruto['linha'], str(e)))
+
+    lidos, inseridos = importar_lancamentos(lancamentos(), user_id)
+    texto.detach()  # o arquivo binário é fechado por quem o abriu
+    return {
+        'lidos': lidos,
+        'inseridos': inseridos,
+        'duplicados': lidos - inseridos,
+        'rejeitadas': rejeitadas,
+        'segundos': time.perf_counter() - comeco,
+    }
 
-def criar_relatorio_comparativo(df_atual, df_anterior, mes_atual, ano_atual, mes_anterior, ano_anterior):
-    # DFs aqui JÁ VÊM agregados pela regra da categoria principal, pois gerar_relatorio_mensal(detalhado=False) foi usado.
+def criar_relatorio_comparativo(df_atual, df_anterior, mes_atual, ano_atual, mes_anterior, ano_anterior,
+                                perfil=REPORT_PROFILE):
+    # DFs aqui JÁ VÊM agregados pela regra da categoria principal, pois vêm do resumo_mensal (gerar_relatorio_mensal_async).
+    carregar_analise()
     rec_atual = df_atual[df_atual['tipo'] == 'receita']['total'].sum()
     desp_atual = df_atual[df_atual['tipo'] == 'despesa']['total'].sum()
     rec_anterior = df_anterior[df_anterior['tipo'] == 'receita']['total'].sum()
@@ -627,7 +2206,8 @@ def criar_relatorio_comparativo(df_atual, df_anterior, mes_atual, ano_atual, mes
                          axis=1, keys=['atual', 'anterior']).fillna(0)
     df_comp['variacao'] = df_comp['atual'] - df_comp['anterior']
     
-    fig, ax = plt.subplots(figsize=(12, 8))
+    fig = Figure(figsize=(12, 8))
+    ax = fig.subplots()
     df_comp[['anterior', 'atual']].sort_values(by='atual', ascending=True).plot(
         kind='barh', ax=ax, color=['#ff9999', '#ff4d4d'])
     ax.set_title(
@@ -637,11 +2217,8 @@ def criar_relatorio_comparativo(df_atual, df_anterior, mes_atual, ano_atual, mes
     ax.set_ylabel('Categorias')
     ax.legend(['Mês Anterior', 'Mês Atual'])
     
-    plt.tight_layout()
-    buffer = BytesIO()
-    plt.savefig(buffer, format='png', dpi=300)
-    buffer.seek(0)
-    plt.close()
+    fig.tight_layout()
+    imagem, info = salvar_figura(fig, perfil)
     
     saldo_atual = rec_atual - desp_atual
     saldo_anterior = rec_anterior - desp_anterior
@@ -660,7 +2237,374 @@ def criar_relatorio_comparativo(df_atual, df_anterior, mes_atual, ano_atual, mes
         for cat, row in top_aumentos.iterrows():
             caption += f"  • *{cat}*: +{format_brl(row['variacao'])}{calc_percent_change(row['atual'], row['anterior'])}\n"
     
-    return buffer, caption
+    return imagem, caption, info
+
+TENDENCIA_JANELAS = (3, 6, 12)
+TENDENCIA_MAX_CATEGORIAS = 6
+
+def _rotulo_mes_curto(periodo):
+    return f"{meses[calendar.month_name[periodo.month]][:3]}/{periodo.year % 100:02d}"
+
+def criar_relatorio_tendencia(df, inicio, n_meses, categoria=None, perfil=REPORT_PROFILE):
+    # df vem de gerar_tendencia_async: uma linha por (mês, categoria, tipo)
+    carregar_analise()
+    periodos = pd.period_range(inicio, periods=n_meses, freq='M')
+    df = df.assign(mes=pd.to_datetime(df['mes']).dt.to_period('M'))
+    despesas = (df[df['tipo'] == 'despesa']
+                .pivot_table(index='mes', columns='categoria', values='total', aggfunc='sum', fill_value=0)
+                .reindex(periodos, fill_value=0))
+    receitas = df[df['tipo'] == 'receita'].groupby('mes')['total'].sum().reindex(periodos, fill_value=0)
+    rotulos = [_rotulo_mes_curto(p) for p in periodos]
+    x = range(n_meses)
+
+    fig = Figure(figsize=(12, 7))
+    ax = fig.subplots()
+    if categoria:
+        serie = despesas[categoria] if categoria in despesas else pd.Series(0.0, index=periodos)
+        media = serie.mean()
+        ax.plot(x, serie.values, marker='o', color='#ff4d4d', linewidth=2, label=categoria)
+        ax.fill_between(x, serie.values, alpha=0.15, color='#ff4d4d')
+        ax.axhline(media, color='gray', linestyle='--', label=f"Média ({format_brl(float(media))})")
+        ax.set_title(f"Tendência de {categoria} — últimos {n_meses} meses", fontsize=16)
+    else:
+        top = despesas.sum().nlargest(TENDENCIA_MAX_CATEGORIAS).index
+        empilhado = despesas[top]
+        outras = despesas.drop(columns=top).sum(axis=1)
+        if outras.any():
+            empilhado = empilhado.assign(Outras=outras)
+        if not empilhado.empty:
+            # Índice posicional: com PeriodIndex o pandas desloca as barras para o eixo de datas
+            empilhado.reset_index(drop=True).plot(kind='bar', stacked=True, ax=ax, width=0.7, alpha=0.85)
+        ax.plot(x, receitas.values, marker='o', color='#2e7d32', linewidth=2.5, label='Receitas')
+        ax.set_title(f"Receitas x Despesas por Categoria — últimos {n_meses} meses", fontsize=16)
+    ax.set_xticks(list(x))
+    ax.set_xticklabels(rotulos, rotation=0)
+    ax.set_xlabel('')
+    ax.set_ylabel('Valor (R$)')
+    ax.legend(loc='upper left', fontsize=9)
+
+    fig.tight_layout()
+    imagem, info = salvar_figura(fig, perfil)
+
+    if categoria:
+        serie = despesas[categoria] if categoria in despesas else pd.Series(0.0, index=periodos)
+        maior = serie.idxmax()
+        media_anteriores = float(serie.iloc[:-1].mean()) if n_meses > 1 else 0.0
+        caption = (
+            f"📉 *Tendência: {categoria}*\n\n"
+            f"📊 Média: {format_brl(float(serie.mean()))}/mês\n"
+            f"🔝 Maior mês: {_rotulo_mes_curto(maior)} ({format_brl(float(serie[maior]))})\n"
+            f"🗓️ Mês atual: {format_brl(float(serie.iloc[-1]))}"
+            f"{calc_percent_change(float(serie.iloc[-1]), media_anteriores)}\n")
+    else:
+        total_despesas = despesas.sum(axis=1)
+        saldo = float(receitas.sum() - total_despesas.sum())
+        caption = (
+            f"📉 *Tendência — últimos {n_meses} meses*\n\n"
+            f"💰 Receitas: média {format_brl(float(receitas.mean()))}/mês\n"
+            f"💸 Despesas: média {format_brl(float(total_despesas.mean()))}/mês\n"
+            f"*{'💚 Saldo' if saldo >= 0 else '❤️ Saldo'} no período: {format_brl(saldo)}*\n")
+        medias = despesas.mean().nlargest(3)
+        if not medias.empty:
+            caption += "\n*Maiores categorias (média/mês):*\n"
+            for cat, valor in medias.items():
+                caption += f"  • *{cat}*: {format_brl(float(valor))}\n"
+
+    return imagem, caption, info
+
+# --- POOL DE RENDERIZAÇÃO DE GRÁFICOS ---
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "1"))
+RENDER_QUEUE_SIZE = int(os.getenv("RENDER_QUEUE_SIZE", "4"))
+RENDER_TIMEOUT = float(os.getenv("RENDER_TIMEOUT", "60"))
+
+class RenderFilaCheiaError(Exception):
+    """Há mais relatórios aguardando renderização do que a fila comporta"""
+
+_render_executor = None
+_render_slots = None
+
+def _get_render_executor():
+    global _render_executor
+    if _render_executor is None:
+        # 'spawn' evita herdar threads (pool do banco, httpx) de um fork
+        _render_executor = ProcessPoolExecutor(
+            max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _render_executor
+
+def encerrar_render_executor(forcar=False):
+    """Encerra o pool de renderização; com forcar=True mata os processos em andamento"""
+    global _render_executor
+    executor, _render_executor = _render_executor, None
+    if executor is None:
+        return
+    if forcar:
+        # ProcessPoolExecutor não cancela tarefas já em execução: termina os workers
+        for processo in list((executor._processes or {}).values()):
+            processo.terminate()
+    executor.shutdown(wait=not forcar, cancel_futures=True)
+
+async def renderizar_relatorio(tipo, func, *args):
+    """Executa func(*args) no pool de processos e devolve o resultado (imagem e info)"""
+    global _render_slots
+    if _render_slots is None:
+        _render_slots = asyncio.Semaphore(RENDER_WORKERS + RENDER_QUEUE_SIZE)
+    if _render_slots.locked():
+        raise RenderFilaCheiaError(f"Fila de renderização cheia ({RENDER_QUEUE_SIZE})")
+
+    async with _render_slots:
+        loop = asyncio.get_running_loop()
+        inicio = time.perf_counter()
+        try:
+            resultado = await asyncio.wait_for(
+                loop.run_in_executor(_get_render_executor(), func, *args), RENDER_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.error(f"Renderização de '{tipo}' excedeu {RENDER_TIMEOUT:.0f}s; reiniciando o pool")
+            encerrar_render_executor(forcar=True)
+            raise
+        except BrokenProcessPool:
+            logging.error("Pool de renderização quebrado; será recriado na próxima chamada")
+            encerrar_render_executor(forcar=True)
+            raise
+
+    imagem = resultado[0] if isinstance(resultado, tuple) else resultado
+    registrar_relatorio(tipo, time.perf_counter() - inicio, _tamanho_buffer(imagem))
+    if isinstance(resultado, tuple) and isinstance(resultado[-1], dict):
+        info = resultado[-1]
+        logging.info(f"Relatório '{tipo}' renderizado: {info['largura']}x{info['altura']} "
+                     f"@{info['dpi']}dpi {info['formato']} ({info['perfil']}), {info['bytes']} bytes")
+    return resultado
+
+# --- CACHE DE RELATÓRIOS ---
+# Os artefatos (conteúdo + legenda) são endereçados pelo hash de (tipo, mês, ano,
+# versão dos dados). Como a versão muda a cada escrita no mês, uma entrada nunca
+# precisa ser invalidada: ela só deixa de ser procurada e sai por LRU.
+REPORT_CACHE_SIZE = int(os.getenv("REPORT_CACHE_SIZE", "32"))
+REPORT_CACHE_MAX_BYTES = int(os.getenv("REPORT_CACHE_MAX_MB", "64")) * 1024 * 1024
+REPORT_CACHE_DIR = os.getenv("REPORT_CACHE_DIR")  # camada em disco opcional
+REPORT_CACHE_DIR_MAX_BYTES = int(os.getenv("REPORT_CACHE_DIR_MAX_MB", "256")) * 1024 * 1024
+REPORT_CACHE_FORMATO = 2  # incrementar quando a aparência dos relatórios mudar
+
+_relatorios_cache = OrderedDict()
+_relatorios_cache_lock = threading.Lock()
+_relatorios_cache_stats = {'hits': 0, 'hits_disco': 0, 'hits_file_id': 0, 'misses': 0, 'remocoes': 0, 'bytes': 0}
+
+def chave_relatorio(tipo, *partes):
+    """Chave do cache para um relatório determinado por tipo e partes (mês, ano, versão...)"""
+    texto = '|'.join(str(parte) for parte in (REPORT_CACHE_FORMATO, tipo, *partes))
+    return hashlib.sha256(texto.encode()).hexdigest()
+
+def _ler_relatorio_disco(chave):
+    caminho = os.path.join(REPORT_CACHE_DIR, chave)
+    try:
+        with open(caminho, 'rb') as f:
+            cabecalho = json.loads(f.readline())
+            conteudo = f.read()
+        os.utime(caminho)  # mantém a ordem de uso para a poda
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.warning(f"Cache de relatório em disco ilegível ({chave[:12]}): {e}")
+        return None
+    return conteudo, cabecalho.get('legenda')
+
+def _podar_cache_disco():
+    """Remove os arquivos menos usados até o diretório caber no limite"""
+    arquivos = []
+    for entrada in os.scandir(REPORT_CACHE_DIR):
+        if entrada.is_file() and not entrada.name.endswith('.tmp'):
+            stat = entrada.stat()
+            arquivos.append((stat.st_mtime, stat.st_size, entrada.path))
+    total = sum(tamanho for _, tamanho, _ in arquivos)
+    for _, tamanho, caminho in sorted(arquivos):
+        if total <= REPORT_CACHE_DIR_MAX_BYTES:
+            break
+        try:
+            os.remove(caminho)
+        except FileNotFoundError:
+            pass
+        total -= tamanho
+
+def _gravar_relatorio_disco(chave, conteudo, legenda):
+    caminho = os.path.join(REPORT_CACHE_DIR, chave)
+    temporario = f"{caminho}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(REPORT_CACHE_DIR, exist_ok=True)
+        with open(temporario, 'wb') as f:
+            f.write(json.dumps({'legenda': legenda}).encode() + b'\n')
+            f.write(conteudo)
+        os.replace(temporario, caminho)
+        _podar_cache_disco()
+    except OSError as e:
+        logging.warning(f"Não foi possível gravar o relatório no cache em disco: {e}")
+
+def _guardar_relatorio_memoria(chave, artefato):
+    if REPORT_CACHE_SIZE <= 0 or len(artefato[0]) > REPORT_CACHE_MAX_BYTES:
+        return
+    with _relatorios_cache_lock:
+        anterior = _relatorios_cache.pop(chave, None)
+        if anterior is not None:
+            _relatorios_cache_stats['bytes'] -= len(anterior[0])
+        _relatorios_cache[chave] = artefato
+        _relatorios_cache_stats['bytes'] += len(artefato[0])
+        while (len(_relatorios_cache) > REPORT_CACHE_SIZE
+               or _relatorios_cache_stats['bytes'] > REPORT_CACHE_MAX_BYTES):
+            _, removido = _relatorios_cache.popitem(last=False)
+            _relatorios_cache_stats['bytes'] -= len(removido[0])
+            _relatorios_cache_stats['remocoes'] += 1
+
+async def obter_relatorio_cache_async(chave):
+    """Devolve (conteudo, legenda) do cache ou None; o disco é lido fora do event loop"""
+    with _relatorios_cache_lock:
+        artefato = _relatorios_cache.get(chave)
+        if artefato is not None:
+            _relatorios_cache.move_to_end(chave)
+            _relatorios_cache_stats['hits'] += 1
+            return artefato
+
+    artefato = await asyncio.to_thread(_ler_relatorio_disco, chave) if REPORT_CACHE_DIR else None
+    with _relatorios_cache_lock:
+        _relatorios_cache_stats['hits_disco' if artefato else 'misses'] += 1
+    if artefato:
+        _guardar_relatorio_memoria(chave, artefato)
+    return artefato
+
+async def guardar_relatorio_cache_async(chave, conteudo, legenda=None):
+    """Guarda um relatório renderizado na memória e, se configurado, no disco (fora do event loop)"""
+    artefato = (conteudo, legenda)
+    _guardar_relatorio_memoria(chave, artefato)
+    if REPORT_CACHE_DIR:
+        await asyncio.to_thread(_gravar_relatorio_disco, chave, conteudo, legenda)
+    return artefato
+
+def get_relatorios_cache_stats():
+    with _relatorios_cache_lock:
+        return {**_relatorios_cache_stats, 'itens': len(_relatorios_cache)}
+
+# file_id devolvido pelo Telegram para cada relatório enviado. Guarda só a última
+# versão de cada (tipo, mês, ano): quando os dados mudam a chave deixa de bater
+# e a entrada é descartada.
+_file_ids_relatorios = {}
+
+def obter_file_id_relatorio(slot, chave):
+    """Devolve (file_id, legenda) se o relatório desta versão já foi enviado"""
+    with _relatorios_cache_lock:
+        registro = _file_ids_relatorios.get(slot)
+        if registro is None:
+            return None
+        if registro[0] != chave:
+            del _file_ids_relatorios[slot]
+            return None
+        _relatorios_cache_stats['hits_file_id'] += 1
+        return registro[1], registro[2]
+
+def guardar_file_id_relatorio(slot, chave, mensagem, legenda):
+    arquivo = mensagem.photo[-1] if mensagem.photo else mensagem.document
+    if arquivo is None:
+        return
+    with _relatorios_cache_lock:
+        _file_ids_relatorios[slot] = (chave, arquivo.file_id, legenda)
+
+def descartar_file_id_relatorio(slot):
+    with _relatorios_cache_lock:
+        _file_ids_relatorios.pop(slot, None)
+
+async def _enviar_arquivo_relatorio(context, chat_id, arquivo, legenda, filename=None):
+    if filename:
+        return await context.bot.send_document(
+            chat_id=chat_id, document=arquivo, filename=filename, caption=legenda)
+    return await context.bot.send_photo(
+        chat_id=chat_id, photo=arquivo, caption=legenda, parse_mode='Markdown')
+
+async def enviar_relatorio(context, chat_id, slot, chave, gerar, filename=None):
+    """Envia um relatório pelo file_id já conhecido, pelo cache ou gerando-o com gerar().
+
+    gerar() devolve (conteudo, legenda) ou None quando não há o que enviar
+    (e nesse caso já avisou o usuário); o conteúdo pode ser bytes ou um arquivo,
+    que é fechado após o envio. Com filename o envio é como documento.
+    Retorna True se algo foi enviado.
+    """
+    enviado = obter_file_id_relatorio(slot, chave)
+    if enviado is not None:
+        file_id, legenda = enviado
+        try:
+            await _enviar_arquivo_relatorio(context, chat_id, file_id, legenda, filename)
+            return True
+        except BadRequest as e:
+            logging.warning(f"file_id do relatório {slot} recusado, reenviando o arquivo: {e}")
+            descartar_file_id_relatorio(slot)
+
+    artefato = await obter_relatorio_cache_async(chave) or await gerar()
+    if artefato is None:
+        return False
+    conteudo, legenda = artefato
+    try:
+        mensagem = await _enviar_arquivo_relatorio(context, chat_id, conteudo, legenda, filename)
+    finally:
+        if hasattr(conteudo, 'close'):
+            conteudo.close()
+    guardar_file_id_relatorio(slot, chave, mensagem, legenda)
+    return True
+
+async def avisar_falha_renderizacao(query, erro):
+    """Informa ao usuário que o gráfico não pôde ser gerado agora"""
+    if isinstance(erro, RenderFilaCheiaError):
+        texto = "⏳ Muitos relatórios sendo gerados agora. Tente novamente em instantes."
+    else:
+        texto = "😕 Não consegui gerar o gráfico a tempo. Tente novamente."
+    await query.edit_message_text(
+        texto,
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("⬅️ Voltar aos Relatórios", callback_data="relatorios")
+        ]]))
+
+# --- CACHE DE MENSAGENS RENDERIZADAS ---
+# Último (texto, teclado, parse_mode) exibido em cada (chat_id, message_id). Editar
+# para o mesmo conteúdo é pulado sem chamar a API. O AgendadorTelegram descarta a
+# entrada a cada edição ou remoção e a regrava só com a edição que chegou à API,
+# já que edições coalescidas nunca aparecem na tela.
+MENSAGENS_CACHE_SIZE = int(os.getenv("MENSAGENS_CACHE_SIZE", "512"))
+_mensagens_renderizadas = OrderedDict()
+_mensagens_stats = {'cache': 0, 'nao_modificada': 0}
+
+def _guardar_mensagem_renderizada(chat_id, message_id, conteudo):
+    _mensagens_renderizadas[(chat_id, message_id)] = conteudo
+    _mensagens_renderizadas.move_to_end((chat_id, message_id))
+    while len(_mensagens_renderizadas) > MENSAGENS_CACHE_SIZE:
+        _mensagens_renderizadas.popitem(last=False)
+
+def descartar_mensagem_renderizada(chat_id, message_id):
+    _mensagens_renderizadas.pop((chat_id, message_id), None)
+
+async def editar_ou_enviar(context, chat_id, message_id, text, reply_markup=None, parse_mode='Markdown'):
+    """Edita a mensagem, ou envia uma nova se ela não puder ser editada; devolve o message_id exibido"""
+    conteudo = (text, reply_markup, parse_mode)
+    if message_id:
+        if _mensagens_renderizadas.get((chat_id, message_id)) == conteudo:
+            _mensagens_stats['cache'] += 1
+            _mensagens_renderizadas.move_to_end((chat_id, message_id))
+            return message_id
+        try:
+            await context.bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=message_id,
+                text=text,
+                reply_markup=reply_markup,
+                parse_mode=parse_mode)
+            return message_id
+        except BadRequest as e:
+            # Mesmo conteúdo que já está na tela: para o usuário a edição deu certo
+            if 'message is not modified' in str(e).lower():
+                _mensagens_stats['nao_modificada'] += 1
+                return message_id
+            logging.warning(f"Falha ao editar mensagem {message_id}: {e}. Enviando nova.")
+
+    sent_message = await context.bot.send_message(
+        chat_id=chat_id,
+        text=text,
+        reply_markup=reply_markup,
+        parse_mode=parse_mode)
+    _guardar_mensagem_renderizada(chat_id, sent_message.message_id, conteudo)
+    return sent_message.message_id
 
 async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, message_id=None):
     keyboard = [
@@ -681,30 +2625,13 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, mes
     text = "🏠 *Menu Principal*\n\nO que vamos organizar agora?"
     chat_id = update.effective_chat.id
     
-    if message_id:
-        try:
-            await context.bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=message_id,
-                text=text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode='Markdown')
-        except Exception:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode='Markdown')
-    else:
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown')
+    await editar_ou_enviar(context, chat_id, message_id, text, InlineKeyboardMarkup(keyboard))
 
 # Função atualizada para usar is_edited
-async def send_or_edit_summary(context: ContextTypes.DEFAULT_TYPE, chat_id, tx_id, message_id=None, is_edited=False):
-    tx = get_transacao(tx_id)
+# Aceita a linha da transação (como devolvida por add/update) ou apenas o ID
+async def send_or_edit_summary(context: ContextTypes.DEFAULT_TYPE, chat_id, tx, message_id=None, is_edited=False):
+    if not isinstance(tx, (tuple, list)):
+        tx = await get_transacao_async(tx)
     if not tx:
         return
 
@@ -730,35 +2657,14 @@ async def send_or_edit_summary(context: ContextTypes.DEFAULT_TYPE, chat_id, tx_i
         InlineKeyboardButton("✏️ Editar Transação", callback_data=f"edit_tx_{_id}")
     ]])
 
-    if message_id:
-        try:
-            await context.bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=message_id,
-                text=feedback,
-                reply_markup=keyboard,
-                parse_mode='Markdown')
-        except Exception as e:
-            logging.warning(f"Falha ao editar mensagem {message_id}: {e}. Enviando nova.")
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=feedback,
-                reply_markup=keyboard,
-                parse_mode='Markdown')
-    else:
-        sent_message = await context.bot.send_message(
-            chat_id=chat_id, 
-            text=feedback, 
-            reply_markup=keyboard, 
-            parse_mode='Markdown')
-        return sent_message.message_id
+    return await editar_ou_enviar(context, chat_id, message_id, feedback, keyboard)
 
 async def start_command(update, context):
     user_id = str(update.message.from_user.id)
     first_name = update.message.from_user.first_name
     
     try:
-        add_user(user_id, first_name)
+        await add_user_async(user_id, first_name)
     except Exception as e:
         logging.error(f"Erro ao adicionar usuário: {e}")
     
@@ -782,6 +2688,134 @@ async def zerar_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=InlineKeyboardMarkup(keyboard),
         parse_mode='Markdown')
 
+async def exportar_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if str(update.effective_user.id) not in AUTHORIZED_USERS:
+        await update.message.reply_text("❌ Desculpe, você não tem permissão para usar este bot.")
+        return
+
+    try:
+        formato, inicio, fim = parse_periodo_exportacao(context.args)
+    except ValueError:
+        await update.message.reply_text(
+            "Uso: `/exportar [csv|xlsx] [início] [fim]`\n"
+            "Datas em dd/mm/aaaa, mm/aaaa ou aaaa. Sem datas, exporta o mês atual.\n"
+            "Ex.: `/exportar xlsx 2024 2025` ou `/exportar 01/03/2025 15/03/2025`",
+            parse_mode='Markdown')
+        return
+
+    periodo = f"{inicio:%d/%m/%Y} a {fim - relativedelta(days=1):%d/%m/%Y}"
+    aviso = await update.message.reply_text(f"⏳ Exportando transações de {periodo}...")
+    try:
+        arquivo, linhas = await exportar_transacoes(formato, inicio, fim)
+    except Exception as e:
+        logging.error(f"Erro ao exportar transações: {e}")
+        await aviso.edit_text("❌ Não foi possível gerar a exportação. Tente novamente.")
+        return
+
+    with arquivo:
+        tamanho = arquivo.seek(0, os.SEEK_END)
+        arquivo.seek(0)
+        if linhas == 0:
+            await aviso.edit_text(f"Nenhuma transação encontrada de {periodo}.")
+            return
+        if tamanho > LIMITE_UPLOAD_BYTES:
+            await aviso.edit_text("📦 O arquivo passou de 50 MB. Escolha um período menor.")
+            return
+        await context.bot.send_document(
+            chat_id=update.effective_chat.id,
+            document=arquivo,
+            filename=f"transacoes_{inicio:%Y%m%d}_{fim - relativedelta(days=1):%Y%m%d}.{formato}",
+            caption=f"📤 {linhas} transações de {periodo}")
+    await aviso.delete()
+
+async def importar_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if str(update.effective_user.id) not in AUTHORIZED_USERS:
+        await update.message.reply_text("❌ Desculpe, você não tem permissão para usar este bot.")
+        return
+
+    cartao = None
+    if context.args:
+        cartao = resolver_cartao(' '.join(context.args))
+        if cartao is None:
+            await update.message.reply_text(
+                "Cartão não encontrado. Use um destes: " + ", ".join(CARTOES_ESPECIAIS))
+            return
+
+    context.user_data['step'] = 'importar_extrato'
+    context.user_data['importar_cartao'] = cartao
+    destino = f" da fatura do *{cartao}*" if cartao else ""
+    await update.message.reply_text(
+        f"📥 Envie o arquivo CSV ou OFX{destino}.\n\n"
+        "No CSV são reconhecidas as colunas de data, descrição e valor "
+        "(e também o formato gerado pelo /exportar).",
+        parse_mode='Markdown')
+
+
+async def documento_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if str(update.effective_user.id) not in AUTHORIZED_USERS:
+        await update.message.reply_text("❌ Desculpe, você não tem permissão para usar este bot.")
+        return
+
+    # O arquivo pode vir depois do /importar ou com "/importar [cartão]" na legenda
+    legenda = (update.message.caption or '').strip()
+    if legenda.startswith('/importar'):
+        argumento = legenda.split(maxsplit=1)[1] if ' ' in legenda else ''
+        cartao = resolver_cartao(argumento) if argumento else None
+        if argumento and cartao is None:
+            await update.message.reply_text(
+                "Cartão não encontrado. Use um destes: " + ", ".join(CARTOES_ESPECIAIS))
+            return
+    elif context.user_data.get('step') == 'importar_extrato':
+        cartao = context.user_data.get('importar_cartao')
+    else:
+        await update.message.reply_text("📎 Para importar um extrato, use /importar e depois envie o arquivo.")
+        return
+    context.user_data.pop('step', None)
+    context.user_data.pop('importar_cartao', None)
+
+    documento = update.message.document
+    if documento.file_size and documento.file_size > LIMITE_DOWNLOAD_BYTES:
+        await update.message.reply_text("📦 O arquivo passa de 20 MB, o limite do Telegram para bots.")
+        return
+
+    aviso = await update.message.reply_text("⏳ Importando extrato...")
+    user_id = str(update.effective_user.id)
+    arquivo = tempfile.SpooledTemporaryFile(max_size=IMPORTACAO_SPOOL_BYTES)
+    try:
+        await add_user_async(user_id, update.effective_user.first_name)
+        arquivo_telegram = await documento.get_file()
+        await arquivo_telegram.download_to_memory(out=arquivo)
+        arquivo.seek(0)
+        # Parse e COPY são síncronos: rodam numa thread com o pool síncrono
+        resultado = await asyncio.to_thread(
+            importar_extrato, arquivo, documento.file_name or '', user_id, cartao)
+    except ValueError as e:
+        await aviso.edit_text(f"❌ {e}")
+        return
+    except Exception as e:
+        logging.error(f"Erro ao importar extrato: {e}")
+        await aviso.edit_text("❌ Não foi possível importar o extrato. Nada foi gravado.")
+        return
+    finally:
+        arquivo.close()
+
+    total = resultado['lidos'] + len(resultado['rejeitadas'])
+    por_segundo = total / resultado['segundos'] if resultado['segundos'] else total
+    texto = (
+        f"✅ Importação concluída\n\n"
+        f"📄 Linhas lidas: {total}\n"
+        f"➕ Importadas: {resultado['inseridos']}\n"
+        f"♻️ Já existentes: {resultado['duplicados']}\n"
+        f"🚫 Rejeitadas: {len(resultado['rejeitadas'])}\n"
+        f"⏱️ {resultado['segundos']:.2f}s ({por_segundo:.0f} linhas/s)")
+    if resultado['rejeitadas']:
+        texto += "\n\nRejeitadas:\n" + "\n".join(
+            f"  • linha {linha}: {motivo}"
+            for linha, motivo in resultado['rejeitadas'][:MAX_REJEITADAS_EXIBIDAS])
+        if len(resultado['rejeitadas']) > MAX_REJEITADAS_EXIBIDAS:
+            texto += f"\n  • ... e mais {len(resultado['rejeitadas']) - MAX_REJEITADAS_EXIBIDAS}"
+    await aviso.edit_text(texto)
+
 # Nova função para apresentar as opções de mês para o relatório
 async def relatorio_escolha_mes(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -831,59 +2865,12 @@ async def relatorio_gerar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ano = int(data_parts[3])
     
     tipo_relatorio = context.user_data.get('relatorio_type', 'grafico')
-    detalhado = (tipo_relatorio == 'detalhado')
     nome_mes_relatorio = f"{meses[calendar.month_name[mes]].capitalize()}/{ano}"
 
     await query.edit_message_text(f"⏳ Gerando relatório {tipo_relatorio} de {nome_mes_relatorio}, um momento...")
     
-    df = gerar_relatorio_mensal(mes, ano, detalhado=detalhado)
-    
-    if df.empty:
-        await query.edit_message_text(
-            f"Nenhum dado encontrado para {nome_mes_relatorio}.",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("⬅️ Voltar aos Relatórios", callback_data="relatorios")
-            ]]))
-        context.user_data.pop('relatorio_type', None)
-        return
-        
-    if detalhado:
-        # Detalhado: Usa categorias como estão no BD (inclui subcategorias)
-        buffer = criar_relatorio_detalhado(df, mes, ano)
-        await context.bot.send_document(
-            chat_id=query.message.chat_id,
-            document=buffer,
-            filename=f"relatorio_{ano}_{mes:02d}_detalhado.txt",
-            caption=f"Aqui está seu relatório detalhado de {nome_mes_relatorio}!")
-    else:
-        # Gráfico: Usa categorias agregadas (cartão principal)
-        buffer = criar_relatorio_visual(df, mes, ano)
-        receitas = df[df['tipo'] == 'receita']['total'].sum()
-        despesas = df[df['tipo'] == 'despesa']['total'].sum()
-        caption = (
-            f"📊 *Resumo de {nome_mes_relatorio}*\n\n"
-            f"💰 Receitas Totais: {format_brl(receitas)}\n"
-            f"💸 Despesas Totais: {format_brl(despesas)}\n"
-            f"*{'💚 Saldo' if (receitas - despesas) >= 0 else '❤️ Saldo'}: {format_brl(receitas - despesas)}*\n"
-        )
-        # Adiciona a quebra de receitas e despesas
-        df_receitas = df[df['tipo'] == 'receita']
-        if not df_receitas.empty:
-            caption += "\n------ *Receitas* ------\n"
-            for _, row in df_receitas.sort_values(by='total', ascending=False).iterrows():
-                caption += f"💰 {row['categoria']}: {format_brl(row['total'])}\n"
-        df_despesas = df[df['tipo'] == 'despesa']
-        if not df_despesas.empty:
-            caption += "\n------ *Despesas* ------\n"
-            for _, row in df_despesas.sort_values(by='total', ascending=False).iterrows():
-                caption += f"💸 {row['categoria']}: {format_brl(row['total'])}\n"
-        
-        await context.bot.send_photo(chat_id=query.message.chat_id,
-                                     photo=buffer, caption=caption, parse_mode='Markdown')
-
-    await query.delete_message()
+    await relatorio_gerar_simples(update, context, mes, ano, tipo_relatorio)
     context.user_data.pop('relatorio_type', None)
-    await show_main_menu(update, context)
 
 
 async def generic_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -900,7 +2887,7 @@ async def generic_button_handler(update: Update, context: ContextTypes.DEFAULT_T
         tipo = data.split('_')[1]
         context.user_data.clear()
         context.user_data['tipo_transacao'] = tipo
-        categorias = get_categorias(tipo)
+        categorias = await get_categorias_async(tipo)
         keyboard = [[InlineKeyboardButton(f"{icone} {nome}", callback_data=f"cat_{nome}")]
                     for nome, icone in categorias]
         keyboard.append([InlineKeyboardButton("⬅️ Voltar ao Menu", callback_data="menu_principal")])
@@ -955,9 +2942,7 @@ async def generic_button_handler(update: Update, context: ContextTypes.DEFAULT_T
     elif data == "saldo":
         # ... (Mantém a lógica de saldo) ...
         hoje = get_brazil_now()
-        df = gerar_relatorio_mensal(hoje.month, hoje.year)
-        receitas = df[df['tipo'] == 'receita']['total'].sum() if not df.empty else 0
-        despesas = df[df['tipo'] == 'despesa']['total'].sum() if not df.empty else 0
+        receitas, despesas = await get_totais_mes_async(hoje.month, hoje.year)
         texto = (
             f"💳 *Saldo de {meses[calendar.month_name[hoje.month]].capitalize()}*\n\n"
             f"💰 Receitas: {format_brl(receitas)}\n"
@@ -972,7 +2957,7 @@ async def generic_button_handler(update: Update, context: ContextTypes.DEFAULT_T
 
     elif data == "extrato":
         # ... (Mantém a lógica de extrato) ...
-        lancamentos = get_ultimos_lancamentos()
+        lancamentos = await get_ultimos_lancamentos_async()
         keyboard = [[InlineKeyboardButton("⬅️ Voltar ao Menu", callback_data="menu_principal")]]
         if not lancamentos:
             texto = "Nenhum lançamento encontrado ainda."
@@ -1004,7 +2989,8 @@ async def generic_button_handler(update: Update, context: ContextTypes.DEFAULT_T
                 InlineKeyboardButton(f"📄 {mes_anterior_nome} (Detalhado)", callback_data=f"rel_gerar_{mes_anterior}_{ano_anterior}_detalhado")
             ],
             [
-                InlineKeyboardButton("📈 Comparativo Mensal", callback_data="rel_comparativo")
+                InlineKeyboardButton("📈 Comparativo Mensal", callback_data="rel_comparativo"),
+                InlineKeyboardButton("📉 Tendência", callback_data="rel_tend")
             ],
             [
                 InlineKeyboardButton("⬅️ Voltar ao Menu", callback_data="menu_principal")
@@ -1037,21 +3023,101 @@ async def generic_button_handler(update: Update, context: ContextTypes.DEFAULT_T
         await query.edit_message_text("⏳ Gerando relatório comparativo, um momento...")
         
         ano_anterior, mes_anterior = get_previous_month(hoje.year, hoje.month)
-        df_atual = gerar_relatorio_mensal(hoje.month, hoje.year)
-        df_anterior = gerar_relatorio_mensal(mes_anterior, ano_anterior)
-        
-        if df_anterior.empty:
+        # A versão é lida antes dos dados: se houver escrita no meio, a próxima
+        # consulta verá versão nova e renderizará de novo
+        versao_atual, versao_anterior = await asyncio.gather(
+            get_versao_mes_async(hoje.month, hoje.year),
+            get_versao_mes_async(mes_anterior, ano_anterior))
+        chave = chave_relatorio('comparativo', REPORT_PROFILE, hoje.month, hoje.year, versao_atual,
+                                mes_anterior, ano_anterior, versao_anterior)
+
+        async def gerar():
+            df_atual, df_anterior = await asyncio.gather(
+                gerar_relatorio_mensal_async(hoje.month, hoje.year),
+                gerar_relatorio_mensal_async(mes_anterior, ano_anterior))
+            
+            if df_anterior.empty:
+                await query.edit_message_text(
+                    "Ainda não há dados do mês anterior para comparar.",
+                    reply_markup=InlineKeyboardMarkup([[
+                        InlineKeyboardButton("⬅️ Voltar", callback_data="relatorios")
+                    ]]))
+                return None
+                
+            try:
+                imagem, caption, _ = await renderizar_relatorio(
+                    'comparativo', criar_relatorio_comparativo,
+                    df_atual, df_anterior, hoje.month, hoje.year, mes_anterior, ano_anterior, REPORT_PROFILE)
+            except (RenderFilaCheiaError, asyncio.TimeoutError, BrokenProcessPool) as e:
+                await avisar_falha_renderizacao(query, e)
+                return None
+            return await guardar_relatorio_cache_async(chave, imagem, caption)
+
+        slot = ('comparativo', REPORT_PROFILE, hoje.month, hoje.year)
+        if not await enviar_relatorio(context, query.message.chat_id, slot, chave, gerar):
+            return
+        await query.delete_message()
+        await show_main_menu(update, context)
+
+    elif data == "rel_tend":
+        keyboard = [
+            [InlineKeyboardButton(f"{n} meses", callback_data=f"rel_tend_{n}") for n in TENDENCIA_JANELAS],
+            [InlineKeyboardButton("⬅️ Voltar", callback_data="relatorios")]
+        ]
+        await query.edit_message_text(
+            "📉 Tendência de quantos meses?",
+            reply_markup=InlineKeyboardMarkup(keyboard))
+
+    elif data.startswith("rel_tend_"):
+        janela, _, filtro = data[9:].partition('_')
+        if not janela.isdigit() or int(janela) not in TENDENCIA_JANELAS:
+            return
+        n_meses = int(janela)
+        hoje = get_brazil_now()
+        fim = date(hoje.year, hoje.month, 1) + relativedelta(months=1)
+        inicio = fim - relativedelta(months=n_meses)
+
+        if not filtro:
+            categorias = await get_categorias_tendencia_async(inicio, fim)
+            keyboard = [[InlineKeyboardButton("📊 Todas as categorias", callback_data=f"rel_tend_{n_meses}_todas")]]
+            for categoria in categorias:
+                callback = f"rel_tend_{n_meses}_cat_{categoria}"
+                if len(callback.encode()) <= 64:  # limite do callback_data do Telegram
+                    keyboard.append([InlineKeyboardButton(f"🏷️ {categoria}", callback_data=callback)])
+            keyboard.append([InlineKeyboardButton("⬅️ Voltar", callback_data="rel_tend")])
             await query.edit_message_text(
-                "Ainda não há dados do mês anterior para comparar.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("⬅️ Voltar", callback_data="relatorios")
-                ]]))
+                f"📉 Tendência dos últimos {n_meses} meses. Quais categorias?",
+                reply_markup=InlineKeyboardMarkup(keyboard))
+            return
+
+        categoria = filtro[4:] if filtro.startswith('cat_') else None
+        await query.edit_message_text("⏳ Gerando relatório de tendência, um momento...")
+        # Qualquer escrita num dos meses da janela muda a tupla de versões
+        versoes = await get_versoes_periodo_async(inicio, fim)
+        chave = chave_relatorio('tendencia', REPORT_PROFILE, n_meses, categoria, inicio, versoes)
+
+        async def gerar():
+            df = await gerar_tendencia_async(inicio, fim, categoria)
+            if df.empty:
+                await query.edit_message_text(
+                    f"Não há lançamentos nos últimos {n_meses} meses"
+                    f"{f' em {categoria}' if categoria else ''}.",
+                    reply_markup=InlineKeyboardMarkup([[
+                        InlineKeyboardButton("⬅️ Voltar", callback_data="rel_tend")
+                    ]]))
+                return None
+            try:
+                imagem, caption, _ = await renderizar_relatorio(
+                    'tendencia', criar_relatorio_tendencia,
+                    df, inicio, n_meses, categoria, REPORT_PROFILE)
+            except (RenderFilaCheiaError, asyncio.TimeoutError, BrokenProcessPool) as e:
+                await avisar_falha_renderizacao(query, e)
+                return None
+            return await guardar_relatorio_cache_async(chave, imagem, caption)
+
+        slot = ('tendencia', REPORT_PROFILE, n_meses, categoria, inicio)
+        if not await enviar_relatorio(context, query.message.chat_id, slot, chave, gerar):
             return
-            
-        buffer, caption = criar_relatorio_comparativo(
-            df_atual, df_anterior, hoje.month, hoje.year, mes_anterior, ano_anterior)
-        await context.bot.send_photo(chat_id=query.message.chat_id,
-                                     photo=buffer, caption=caption, parse_mode='Markdown')
         await query.delete_message()
         await show_main_menu(update, context)
 
@@ -1069,13 +3135,13 @@ async def generic_button_handler(update: Update, context: ContextTypes.DEFAULT_T
 
     elif data == "confirmar_zerar":
         # ... (Mantém a lógica de zerar dados) ...
-        zerar_dados()
+        await zerar_dados_async()
         await query.edit_message_text("✅ Todos os dados foram apagados com sucesso!")
         await show_main_menu(update, context, message_id=query.message.message_id)
 
     elif data == "orc_definir":
         # ... (Mantém a lógica de definir orçamento) ...
-        categorias = get_categorias('despesa')
+        categorias = await get_categorias_async('despesa')
         keyboard = [[InlineKeyboardButton(f"{icone} {nome}", callback_data=f"orc_cat_{nome}")] 
                     for nome, icone in categorias if nome not in SUBCATEGORIAS_CARTAO] # Filtra subcategorias, se houver
         keyboard.append([InlineKeyboardButton("⬅️ Voltar", callback_data="orcamentos")])
@@ -1097,7 +3163,7 @@ async def generic_button_handler(update: Update, context: ContextTypes.DEFAULT_T
     elif data == "orc_ver":
         # ... (Mantém a lógica de ver orçamentos) ...
         hoje = get_brazil_now()
-        orcamentos = get_todos_orcamentos(hoje.month, hoje.year)
+        orcamentos = await get_orcamentos_status_async(hoje.month, hoje.year)
         if not orcamentos:
             await query.edit_message_text(
                 "Nenhum orçamento definido para este mês.",
@@ -1108,8 +3174,7 @@ async def generic_button_handler(update: Update, context: ContextTypes.DEFAULT_T
             return
         texto = f"📋 *Orçamentos de {meses[calendar.month_name[hoje.month]].capitalize()}*\n\n"
         keyboard = []
-        for categoria, limite in orcamentos:
-            _, gasto, disponivel, percentual = get_orcamento_status(categoria, hoje.month, hoje.year)
+        for categoria, limite, gasto, disponivel, percentual in orcamentos:
             barra = "▪" * int(percentual / 10) + "▫" * (10 - int(percentual / 10))
             status = "✅" if disponivel >= 0 else "🆘"
             texto += f"*{categoria}* {status}\n`{barra}` {percentual:.1f}%\n"
@@ -1129,7 +3194,7 @@ async def generic_button_handler(update: Update, context: ContextTypes.DEFAULT_T
         # ... (Mantém a lógica de ver gastos por orçamento) ...
         categoria = data[11:]
         hoje = get_brazil_now()
-        transacoes = get_transacoes_por_categoria(categoria, hoje.month, hoje.year) 
+        transacoes = await get_transacoes_por_categoria_async(categoria, hoje.month, hoje.year) 
         texto = f"💸 *Gastos em {categoria}*\n\n"
         if not transacoes:
             texto += "Nenhum gasto este mês."
@@ -1157,7 +3222,7 @@ async def generic_button_handler(update: Update, context: ContextTypes.DEFAULT_T
     elif data.startswith("edit_tx_"):
         # ... (Mantém a lógica de edição da transação) ...
         tx_id = int(data.split("_")[-1])
-        tx = get_transacao(tx_id)
+        tx = await get_transacao_async(tx_id)
         if not tx:
             await query.edit_message_text("Transação não encontrada. 😕",
                                          reply_markup=InlineKeyboardMarkup([[
@@ -1199,7 +3264,7 @@ async def generic_button_handler(update: Update, context: ContextTypes.DEFAULT_T
     elif data.startswith("confirm_delete_"):
         # ... (Mantém a lógica de confirmação de exclusão) ...
         tx_id = int(data.split("_")[-1])
-        tx = get_transacao(tx_id)
+        tx = await get_transacao_async(tx_id)
         
         if not tx:
             await query.edit_message_text("❌ Transação não encontrada.",
@@ -1232,7 +3297,7 @@ async def generic_button_handler(update: Update, context: ContextTypes.DEFAULT_T
         # ... (Mantém a lógica de execução de exclusão) ...
         tx_id = int(data.split("_")[-1])
         
-        result = delete_transacao(tx_id)
+        result = await delete_transacao_async(tx_id)
         
         if result is not None and result > 0:
             await query.edit_message_text(
@@ -1279,10 +3344,10 @@ async def generic_button_handler(update: Update, context: ContextTypes.DEFAULT_T
 
         elif campo == 'categoria':
             context.user_data['step'] = 'editar_categoria_transacao'
-            tx = get_transacao(tx_id)
+            tx = await get_transacao_async(tx_id)
             _id, _user, tipo_tx, _cat, _valor, _desc, _data, _created = tx
             
-            categorias = get_categorias(tipo_tx)
+            categorias = await get_categorias_async(tipo_tx)
             keyboard = [[InlineKeyboardButton(f"{icone} {nome}", callback_data=f"edit_cat_select_{nome}")] 
                         for nome, icone in categorias]
             
@@ -1309,10 +3374,10 @@ async def generic_button_handler(update: Update, context: ContextTypes.DEFAULT_T
         message_id_to_edit = context.user_data.get('message_id_to_edit')
         
         if tx_id and context.user_data.get('step') == 'editar_categoria_transacao':
-            sucesso = update_transacao_campo(tx_id, 'categoria', categoria)
+            tx = await update_transacao_campo_async(tx_id, 'categoria', categoria)
             
-            if sucesso:
-                await send_or_edit_summary(context, query.message.chat_id, tx_id, message_id_to_edit, is_edited=True)
+            if tx:
+                await send_or_edit_summary(context, query.message.chat_id, tx, message_id_to_edit, is_edited=True)
                 await query.answer(text=f"✅ Categoria atualizada para {categoria}.")
             else:
                 await query.edit_message_text(
@@ -1329,54 +3394,81 @@ async def generic_button_handler(update: Update, context: ContextTypes.DEFAULT_T
                                          ]]))
 
 # Função auxiliar para gerar relatório (usada pela nova lógica)
+def montar_legenda_resumo(df, nome_mes_relatorio, receitas, despesas):
+    """Legenda do gráfico mensal com totais e valores por categoria"""
+    caption = (
+        f"📊 *Resumo de {nome_mes_relatorio}*\n\n"
+        f"💰 Receitas Totais: {format_brl(receitas)}\n"
+        f"💸 Despesas Totais: {format_brl(despesas)}\n"
+        f"*{'💚 Saldo' if (receitas - despesas) >= 0 else '❤️ Saldo'}: {format_brl(receitas - despesas)}*\n"
+    )
+    df_receitas = df[df['tipo'] == 'receita']
+    if not df_receitas.empty:
+        caption += "\n------ *Receitas* ------\n"
+        for _, row in df_receitas.sort_values(by='total', ascending=False).iterrows():
+            caption += f"💰 {row['categoria']}: {format_brl(row['total'])}\n"
+    df_despesas = df[df['tipo'] == 'despesa']
+    if not df_despesas.empty:
+        caption += "\n------ *Despesas* ------\n"
+        for _, row in df_despesas.sort_values(by='total', ascending=False).iterrows():
+            caption += f"💸 {row['categoria']}: {format_brl(row['total'])}\n"
+    return caption
+
 async def relatorio_gerar_simples(update: Update, context: ContextTypes.DEFAULT_TYPE, mes, ano, tipo_relatorio):
     query = update.callback_query
     
     detalhado = (tipo_relatorio == 'detalhado')
     nome_mes_relatorio = f"{meses[calendar.month_name[mes]].capitalize()}/{ano}"
 
-    df = gerar_relatorio_mensal(mes, ano, detalhado=detalhado)
-    
-    if df.empty:
+    # Versão lida antes dos dados (ver rel_comparativo)
+    versao = await get_versao_mes_async(mes, ano)
+    # O perfil só afeta imagens; o detalhado é texto
+    perfil = None if detalhado else REPORT_PROFILE
+    chave = chave_relatorio(tipo_relatorio, perfil, mes, ano, versao)
+
+    async def avisar_sem_dados():
         await query.edit_message_text(
             f"Nenhum dado encontrado para {nome_mes_relatorio}.",
             reply_markup=InlineKeyboardMarkup([[
                 InlineKeyboardButton("⬅️ Voltar aos Relatórios", callback_data="relatorios")
             ]]))
-        return
-        
-    if detalhado:
-        # Detalhado: Usa categorias como estão no BD (inclui subcategorias)
-        buffer = criar_relatorio_detalhado(df, mes, ano)
-        await context.bot.send_document(
-            chat_id=query.message.chat_id,
-            document=buffer,
-            filename=f"relatorio_{ano}_{mes:02d}_detalhado.txt",
-            caption=f"Aqui está seu relatório detalhado de {nome_mes_relatorio}!")
-    else:
+
+    async def gerar():
+        if detalhado:
+            # Detalhado: Usa categorias como estão no BD (inclui subcategorias)
+            arquivo = await gerar_relatorio_detalhado_async(mes, ano)
+            if arquivo is None:
+                await avisar_sem_dados()
+                return None
+            legenda = f"Aqui está seu relatório detalhado de {nome_mes_relatorio}!"
+            if arquivo.seek(0, os.SEEK_END) > DETALHADO_SPOOL_BYTES:
+                # Grande demais para o cache em memória: é enviado direto do arquivo
+                # (repetições usam o file_id)
+                arquivo.seek(0)
+                return arquivo, legenda
+            arquivo.seek(0)
+            with arquivo:
+                return await guardar_relatorio_cache_async(chave, arquivo.read(), legenda)
+
+        df, (receitas, despesas) = await asyncio.gather(
+            gerar_relatorio_mensal_async(mes, ano), get_totais_mes_async(mes, ano))
+        if df.empty:
+            await avisar_sem_dados()
+            return None
+
         # Gráfico: Usa categorias agregadas (cartão principal)
-        buffer = criar_relatorio_visual(df, mes, ano)
-        receitas = df[df['tipo'] == 'receita']['total'].sum()
-        despesas = df[df['tipo'] == 'despesa']['total'].sum()
-        caption = (
-            f"📊 *Resumo de {nome_mes_relatorio}*\n\n"
-            f"💰 Receitas Totais: {format_brl(receitas)}\n"
-            f"💸 Despesas Totais: {format_brl(despesas)}\n"
-            f"*{'💚 Saldo' if (receitas - despesas) >= 0 else '❤️ Saldo'}: {format_brl(receitas - despesas)}*\n"
-        )
-        df_receitas = df[df['tipo'] == 'receita']
-        if not df_receitas.empty:
-            caption += "\n------ *Receitas* ------\n"
-            for _, row in df_receitas.sort_values(by='total', ascending=False).iterrows():
-                caption += f"💰 {row['categoria']}: {format_brl(row['total'])}\n"
-        df_despesas = df[df['tipo'] == 'despesa']
-        if not df_despesas.empty:
-            caption += "\n------ *Despesas* ------\n"
-            for _, row in df_despesas.sort_values(by='total', ascending=False).iterrows():
-                caption += f"💸 {row['categoria']}: {format_brl(row['total'])}\n"
-                
-        await context.bot.send_photo(chat_id=query.message.chat_id,
-                                     photo=buffer, caption=caption, parse_mode='Markdown')
+        try:
+            imagem, _ = await renderizar_relatorio('visual', criar_relatorio_visual, df, mes, ano, perfil)
+        except (RenderFilaCheiaError, asyncio.TimeoutError, BrokenProcessPool) as e:
+            await avisar_falha_renderizacao(query, e)
+            return None
+        return await guardar_relatorio_cache_async(
+            chave, imagem, montar_legenda_resumo(df, nome_mes_relatorio, receitas, despesas))
+
+    filename = f"relatorio_{ano}_{mes:02d}_detalhado.txt" if detalhado else None
+    slot = (tipo_relatorio, perfil, mes, ano)
+    if not await enviar_relatorio(context, query.message.chat_id, slot, chave, gerar, filename):
+        return
 
     await query.delete_message()
     await show_main_menu(update, context)
@@ -1505,18 +3597,18 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             except Exception:
                 pass
 
-        tx_id = add_transacao(str(user_id), context.user_data['tipo_transacao'],
-                              context.user_data['categoria_transacao'],
-                              context.user_data['valor_transacao'],
-                              descricao,
-                              context.user_data['data_transacao'])
+        tx = await add_transacao_async(str(user_id), context.user_data['tipo_transacao'],
+                                       context.user_data['categoria_transacao'],
+                                       context.user_data['valor_transacao'],
+                                       descricao,
+                                       context.user_data['data_transacao'])
 
-        sent_message_id = await send_or_edit_summary(context, chat_id, tx_id)
+        sent_message_id = await send_or_edit_summary(context, chat_id, tx)
 
         if context.user_data['tipo_transacao'] == 'despesa':
             data_obj = datetime.strptime(context.user_data['data_transacao'], '%Y-%m-%d')
-            categoria_principal = context.user_data['categoria_transacao'].split(' - ')[0]
-            _, _, _, percentual = get_orcamento_status(
+            categoria_principal, _ = separar_categoria(context.user_data['categoria_transacao'])
+            _, _, _, percentual = await get_orcamento_status_async(
                 categoria_principal, data_obj.month, data_obj.year)
             alerta = get_alerta_divertido(categoria_principal, percentual)
             if alerta:
@@ -1532,7 +3624,7 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             valor = float(text.replace('.', '').replace(',', '.'))
             categoria = context.user_data['categoria_orcamento']
             hoje = get_brazil_now()
-            set_orcamento(categoria, valor, hoje.month, hoje.year)
+            await set_orcamento_async(categoria, valor, hoje.month, hoje.year)
             feedback = f"✅ Orçamento de *{categoria}* definido para *{format_brl(valor)}*."
             keyboard = [
                 [InlineKeyboardButton("🎯 Definir Outro Orçamento", callback_data="orc_definir")],
@@ -1577,11 +3669,11 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             tx_id = context.user_data.get('edit_tx_id')
             message_id_to_edit = context.user_data.get('message_id_to_edit')
             
-            sucesso = update_transacao_valor(tx_id, novo_valor)
-            if not sucesso:
+            tx = await update_transacao_valor_async(tx_id, novo_valor)
+            if not tx:
                 raise ValueError("Falha ao atualizar")
 
-            await send_or_edit_summary(context, chat_id, tx_id, message_id_to_edit, is_edited=True)
+            await send_or_edit_summary(context, chat_id, tx, message_id_to_edit, is_edited=True)
             
             await context.bot.send_message(
                 chat_id=chat_id,
@@ -1604,10 +3696,10 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         tx_id = context.user_data.get('edit_tx_id')
         message_id_to_edit = context.user_data.get('message_id_to_edit')
         
-        sucesso = update_transacao_campo(tx_id, 'descricao', descricao)
+        tx = await update_transacao_campo_async(tx_id, 'descricao', descricao)
         
-        if sucesso:
-            await send_or_edit_summary(context, chat_id, tx_id, message_id_to_edit, is_edited=True)
+        if tx:
+            await send_or_edit_summary(context, chat_id, tx, message_id_to_edit, is_edited=True)
             
             await context.bot.send_message(
                 chat_id=chat_id,
@@ -1631,6 +3723,8 @@ async def command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def post_init(application: Application):
+    global _tarefa_aquecimento
+    await init_database_async()
     await application.bot.set_my_commands([
         BotCommand("start", "▶️ Iniciar e ver o menu"),
         BotCommand("gastou", "💸 Lançar nova despesa"),
@@ -1638,58 +3732,261 @@ async def post_init(application: Application):
         BotCommand("saldo", "📋 Ver saldo do mês"),
         BotCommand("relatorio", "📊 Gerar um relatório"),
         BotCommand("orcamento", "🎯 Gerenciar orçamentos"),
+        BotCommand("exportar", "📤 Exportar transações (CSV/XLSX)"),
+        BotCommand("importar", "📥 Importar extrato (CSV/OFX)"),
         BotCommand("zerar", "🗑️ Apagar todos os dados"),
     ])
+    if REPORT_WARMUP:
+        # Roda junto com o polling: o bot já atende enquanto os imports acontecem
+        _tarefa_aquecimento = asyncio.create_task(aquecer_relatorios())
+
+
+_tarefa_aquecimento = None
+
+async def aquecer_relatorios():
+    """Carrega a pilha de análise e sobe o worker de renderização em segundo plano"""
+    try:
+        await carregar_analise_async()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(_get_render_executor(), carregar_analise)
+        logging.info("Aquecimento dos relatórios concluído")
+    except Exception as e:
+        logging.warning(f"Falha no aquecimento dos relatórios: {e}")
+
+
+async def post_shutdown(application: Application):
+    await close_database_async()
+    encerrar_render_executor()
+
+
+class ProcessadorPorChat(BaseUpdateProcessor):
+    """Processa updates de chats diferentes em paralelo e os de um mesmo chat em ordem.
+
+    Os fluxos de lançamento e edição guardam o passo atual em context.user_data;
+    serializar por chat evita que dois updates do mesmo usuário intercalem esses passos.
+    A trava do chat é obtida antes da vaga no semáforo global: updates enfileirados
+    atrás de um chat ocupado não consomem as vagas dos outros chats.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._travas = {}  # chat/usuário -> [lock, updates usando o lock]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        self._travas.clear()
+
+    async def process_update(self, update, coroutine):
+        chat = getattr(update, 'effective_chat', None)
+        usuario = getattr(update, 'effective_user', None)
+        chave = chat.id if chat else (usuario.id if usuario else None)
+        if chave is None:
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+            return
+        trava = self._travas.setdefault(chave, [asyncio.Lock(), 0])
+        trava[1] += 1
+        try:
+            async with trava[0], self._semaphore:
+                await self.do_process_update(update, coroutine)
+        finally:
+            trava[1] -= 1
+            if not trava[1]:
+                del self._travas[chave]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
 
 
 def run_bot():
     """Função para rodar o bot do Telegram"""
-    application = Application.builder().token(TOKEN).post_init(post_init).build()
-
-    application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(CommandHandler("zerar", zerar_command))
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .request(HTTPXRequestInstrumentado(connection_pool_size=TELEGRAM_POOL_SIZE))
+        .rate_limiter(agendador_telegram)
+        .concurrent_updates(ProcessadorPorChat(BOT_CONCURRENT_UPDATES))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown))
+    if BOT_MODE == 'webhook':
+        # As atualizações chegam pela rota do servidor web; não há Updater fazendo polling
+        builder = builder.updater(None)
+    application = builder.build()
+
+    application.add_handler(CommandHandler("start", instrumentar_handler(start_command)))
+    application.add_handler(CommandHandler("zerar", instrumentar_handler(zerar_command)))
+    application.add_handler(CommandHandler("exportar", instrumentar_handler(exportar_command)))
+    application.add_handler(CommandHandler("importar", instrumentar_handler(importar_command)))
     application.add_handler(
-        CommandHandler(["gastou", "ganhou", "saldo", "relatorio", "orcamento"], command_handler))
+        CommandHandler(["gastou", "ganhou", "saldo", "relatorio", "orcamento"],
+                       instrumentar_handler(command_handler)))
 
     application.add_handler(
-        CallbackQueryHandler(data_button_handler, pattern="^(data_manual|data_).+"))
+        CallbackQueryHandler(instrumentar_handler(data_button_handler), pattern="^(data_manual|data_).+"))
     # Altera o CallbackQueryHandler para lidar com a nova estrutura de relatórios
     application.add_handler(
-        CallbackQueryHandler(generic_button_handler, pattern="^(?!data_manual|data_).+"))
+        CallbackQueryHandler(instrumentar_handler(generic_button_handler), pattern="^(?!data_manual|data_).+"))
 
     application.add_handler(
-        MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
+        MessageHandler(filters.TEXT & ~filters.COMMAND, instrumentar_handler(message_handler)))
+    application.add_handler(
+        MessageHandler(filters.Document.ALL, instrumentar_handler(documento_handler)))
 
     print("🤖 Bot assistente financeiro v14.0 (Relatórios de Mês Anterior) iniciado!")
-    application.run_polling()
+    asyncio.run(run_servicos(application))
+
 
+class ServidorWeb(uvicorn.Server):
+    """Servidor uvicorn que deixa os sinais com run_servicos, que desliga bot e servidor juntos"""
+
+    @contextlib.contextmanager
+    def capture_signals(self):
+        yield
+
+    def install_signal_handlers(self):
+        pass
+
+
+def inicializar_banco():
+    """Abre o pool síncrono, aplica o schema e carrega o catálogo de categorias"""
+    init_database()
+    setup_database()
+    carregar_categorias()
+
+
+async def run_servicos(application):
+    """Roda o bot e o servidor web no mesmo loop até receber SIGINT/SIGTERM"""
+    global _bot_application
+    parar = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sinal in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sinal, parar.set)
 
-def run_web_server():
-    """Função para rodar o servidor web Flask"""
     port = int(os.environ.get('PORT', 5000))
+    servidor = ServidorWeb(uvicorn.Config(app, host='0.0.0.0', port=port, lifespan='off', log_level='warning'))
+
+    # A porta abre antes do banco e do bot: a plataforma vê o processo no ar e o
+    # /health responde 503 ('starting') até a primeira sonda
+    tarefa_servidor = asyncio.create_task(servidor.serve())
     print(f"🌐 Servidor web iniciado na porta {port}")
-    app.run(host='0.0.0.0', port=port, debug=False)
+    try:
+        try:
+            await asyncio.to_thread(inicializar_banco)
+            print("✅ Banco de dados inicializado com sucesso!")
+        except Exception as e:
+            print(f"❌ Erro ao inicializar banco de dados: {e}")
+            return
+
+        # Sem run_polling/run_webhook, os hooks post_init/post_shutdown são chamados aqui
+        async with application:
+            await application.post_init(application)
+            if BOT_MODE == 'webhook':
+                await application.bot.set_webhook(
+                    f"{WEBHOOK_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+                    allowed_updates=Update.ALL_TYPES)
+                print(f"🔗 Webhook registrado em {WEBHOOK_URL}{WEBHOOK_PATH}")
+            else:
+                await application.updater.start_polling()
+            await application.start()
+            _bot_application = application
+            await verificar_saude(application)
+            tarefa_saude = asyncio.create_task(monitorar_saude(application))
+            try:
+                await asyncio.wait(
+                    [tarefa_servidor, asyncio.create_task(parar.wait())],
+                    return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                _bot_application = None
+                tarefa_saude.cancel()
+                if application.updater and application.updater.running:
+                    await application.updater.stop()
+                await application.stop()
+                await application.post_shutdown(application)
+    finally:
+        servidor.should_exit = True
+        await tarefa_servidor
+
+
+def perfil_inicializacao(limite=12):
+    """Mede os imports com `python -X importtime` e imprime os mais lentos"""
+    modulo = os.path.splitext(os.path.basename(__file__))[0]
+    resultado = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f"import {modulo}; {modulo}.carregar_analise()"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    # Linhas no formato "import time: self [us] | cumulative | nome" (indentado pela profundidade)
+    entradas = []
+    for linha in resultado.stderr.splitlines():
+        if not linha.startswith('import time:') or 'cumulative' in linha:
+            continue
+        _, acumulado, nome = linha[len('import time:'):].split('|')
+        profundidade = (len(nome) - len(nome.lstrip()) - 1) // 2
+        entradas.append((nome.strip(), int(acumulado), profundidade))
+
+    indice = next((i for i, (nome, _, prof) in enumerate(entradas) if nome == modulo and prof == 0), None)
+    if indice is None:
+        print(resultado.stderr[-2000:])
+        return
+
+    # Filhos diretos de um import aparecem antes dele; os imports feitos por
+    # carregar_analise() aparecem depois, na profundidade 0
+    diretos = [e for e in entradas[:indice] if e[2] == 1]
+    total_modulo = entradas[indice][1]
+    sob_demanda = [e for e in entradas[indice + 1:] if e[2] == 0]
+    total_sob_demanda = sum(acumulado for _, acumulado, _ in sob_demanda)
+
+    print(f"⏱️ import {modulo}: {total_modulo / 1000:.0f} ms")
+    for nome, acumulado, _ in sorted(diretos, key=lambda e: -e[1])[:limite]:
+        print(f"   {acumulado / 1000:8.1f} ms  {nome}")
+    print(f"⏱️ carregar_analise() (sob demanda): {total_sob_demanda / 1000:.0f} ms")
+    for nome, acumulado, _ in sorted(sob_demanda, key=lambda e: -e[1])[:limite]:
+        print(f"   {acumulado / 1000:8.1f} ms  {nome}")
+
+
+def parse_args():
+    """Lê as opções de linha de comando"""
+    parser = argparse.ArgumentParser(description="Bot assistente financeiro")
+    parser.add_argument(
+        "--rebuild-resumo", action="store_true",
+        help="recalcula a tabela resumo_mensal a partir das transações e sai")
+    parser.add_argument(
+        "--startup-profile", action="store_true",
+        help="mostra o tempo de import dos módulos (python -X importtime) e sai")
+    return parser.parse_args()
 
 
 def main():
     """Função principal que inicia tanto o bot quanto o servidor web"""
-    print("🚀 Iniciando aplicação híbrida (Bot + Servidor Web)...")
+    args = parse_args()
 
-    # Inicia o servidor web em uma thread separada
-    web_thread = threading.Thread(target=run_web_server, daemon=True)
-    web_thread.start()
+    if args.startup_profile:
+        perfil_inicializacao()
+        return
 
-    # Inicia o banco de dados
-    try:
+    if args.rebuild_resumo:
         init_database()
-        setup_database()
-        print("✅ Banco de dados inicializado com sucesso!")
-    except Exception as e:
-        print(f"❌ Erro ao inicializar banco de dados: {e}")
+        try:
+            setup_database()
+            linhas = rebuild_resumo_mensal()
+            print(f"✅ Resumo mensal reconstruído: {linhas} linhas.")
+        finally:
+            close_database()
+        return
+
+    if BOT_MODE == 'webhook' and not (WEBHOOK_URL and WEBHOOK_SECRET):
+        print("❌ BOT_MODE=webhook exige WEBHOOK_URL e WEBHOOK_SECRET")
         return
 
-    # Inicia o bot na thread principal
-    run_bot()
+    print("🚀 Iniciando aplicação híbrida (Bot + Servidor Web)...")
+
+    # Bot e servidor web dividem o mesmo loop na thread principal; o banco é
+    # inicializado por run_servicos depois que a porta já está aberta
+    try:
+        run_bot()
+    finally:
+        close_database()
 
 
 if __name__ == '__main__':